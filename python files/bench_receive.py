@@ -0,0 +1,87 @@
+#    Receive path microbenchmark: lines/sec through the receive thread's line handling, without any handlers registered.
+#    Compares this tree with the per-line regex probe chain it replaced, loaded from git.
+#    Run from this folder with: python bench_receive.py [baseline revision]
+#    Without a revision, the baseline is the parent of the commit that introduced the dispatch table (_handleLine).
+
+import importlib.util
+import os
+import subprocess
+import sys
+import time
+
+import pythonircbot
+
+_ROUNDS = 5
+_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+_LINES = [
+	":alice!~a@host.example PRIVMSG #chan :hello there how is everyone doing today",
+	":bob!~b@other.example JOIN #chan",
+	":bob!~b@other.example PART #chan :bye",
+	":carol!~c@x.example QUIT :Quit: leaving",
+	":irc.server 353 snaibot = #chan :@op +voice normal1 normal2 %hop",
+	":ChanServ!s@services MODE #chan +o alice",
+	"PING :irc.server",
+	":irc.server NOTICE * :*** Looking up your hostname",
+] * 2000
+
+class _NullSocket(object):
+	def _send(self, data, *args, **kwargs):
+		pass
+
+def _findBaseline():
+	# Oldest commit that changed the number of _handleLine definitions, i.e. the one that added it
+	commits = subprocess.check_output(['git', 'log', '--reverse', '--format=%H', '-S', 'def _handleLine', '--', 'pythonircbot.py'], cwd=_FOLDER).split()
+	if not commits:
+		raise SystemExit("Could not find the commit that introduced _handleLine. Pass a baseline revision.")
+	return commits[0].decode() + '^'
+
+def _loadBaseline(revision):
+	source = subprocess.check_output(['git', 'show', '{}:./pythonircbot.py'.format(revision)], cwd=_FOLDER)
+	spec = importlib.util.spec_from_loader('pythonircbot_baseline', loader=None)
+	module = importlib.util.module_from_spec(spec)
+	exec(compile(source, 'pythonircbot@{}'.format(revision), 'exec'), module.__dict__)
+	return module
+
+def _receiver(module):
+	bot = module.Bot('snaibot')
+	bot._s = _NullSocket()
+	bot._verbose = False
+	receiver = module._BotReceiveThread(bot, False)
+	# Only the parsing and dispatch is measured, so channel state updates are left out
+	for name in ('_joinedEvent', '_partedEvent', '_updateNames', '_userModeSet', '_userModeUnset'):
+		getattr(receiver, name).connect(lambda *args: None)
+	return receiver
+
+def _handleLine(module):
+	receiver = _receiver(module)
+	if hasattr(receiver, '_handleLine'):
+		return receiver._handleLine
+	probes = (receiver._privMsg, receiver._joinChannel, receiver._partChannel, receiver._pong, receiver._quitM, receiver._modeset, receiver._modeunset, receiver._names)
+	def handleLine(line):
+		for probe in probes:
+			if probe(line):
+				break
+	return handleLine
+
+def _linesPerSecond(handleLine):
+	best = 0
+	for i in range(_ROUNDS):
+		start = time.perf_counter()
+		for line in _LINES:
+			handleLine(line)
+		best = max(best, len(_LINES) / (time.perf_counter() - start))
+	return best
+
+def main(revision=None):
+	if revision is None:
+		revision = _findBaseline()
+	old = _linesPerSecond(_handleLine(_loadBaseline(revision)))
+	new = _linesPerSecond(_handleLine(pythonircbot))
+	print("{} mixed lines, best of {} rounds".format(len(_LINES), _ROUNDS))
+	print("regex probe chain ({}): {:.0f} lines/s".format(revision, old))
+	print("dispatch table (this tree): {:.0f} lines/s".format(new))
+	print("speedup: {:.1f}x".format(new / old))
+
+if __name__ == '__main__':
+	main(*sys.argv[1:])
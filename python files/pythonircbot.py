@@ -33,12 +33,293 @@ to handle messages, and abstracts many IRC commands.
 __author__ = 'Milan Boers'
 __version__ = '2.0'
 
+import sys
 import socket
+import selectors
 import threading
 import re
-import copy
 import time
 import queue
+import asyncio
+import collections
+import random
+import atexit
+import logging
+
+# Send priorities, highest first. Lines of the same priority are sent in the order they were queued.
+PRIORITY_PROTOCOL = 0	# Keepalive and registration (PONG, NICK, USER, QUIT)
+PRIORITY_MODERATION = 1	# KICK and MODE
+PRIORITY_NORMAL = 2	# Replies
+PRIORITY_BULK = 3	# Long result lists and other output that can wait
+
+# Channel modes that always take an argument, and those that only take one when set, used until the server sends ISUPPORT CHANMODES
+_PARAM_MODES = 'qaohvbeIk'
+_PARAM_MODES_SET = 'lfjJ'
+
+# Prefix modes and their NAMES symbols, highest rank first, used until the server sends ISUPPORT PREFIX
+_DEFAULT_PREFIX = ('qaohv', '~&@%+')
+# Usual rank order, used to place prefix modes the server does not have
+_COMMON_PREFIX = 'qaohv'
+
+# ISUPPORT CASEMAPPING -> table that folds nicknames to lowercase
+_ASCII_UPPER = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+_ASCII_LOWER = 'abcdefghijklmnopqrstuvwxyz'
+_CASEMAPS = {
+	'ascii': str.maketrans(_ASCII_UPPER, _ASCII_LOWER),
+	'rfc1459': str.maketrans(_ASCII_UPPER + '[]\\~', _ASCII_LOWER + '{}|^'),
+	'strict-rfc1459': str.maketrans(_ASCII_UPPER + '[]\\', _ASCII_LOWER + '{}|'),
+}
+
+_log = logging.getLogger('pythonircbot')
+
+# NickServ notices that confirm IDENTIFY
+_IDENTIFIED_RE = re.compile('you are now (identified|recognized|logged in)|password accepted', re.IGNORECASE)
+
+# Handler filters equal to this are skipped instead of being matched
+_MATCH_ALL = '.*'
+_MATCH_ALL_RE = re.compile(_MATCH_ALL)
+
+def _compileFilter(pattern, flags):
+	"""Compiles a handler filter. Returns None for the match-everything default."""
+	if pattern == _MATCH_ALL:
+		return None
+	return re.compile(pattern, flags)
+
+_TAG_ESCAPES = {':': ';', 's': ' ', '\\': '\\', 'r': '\r', 'n': '\n'}
+
+def _unescapeTag(value):
+	"""Unescapes an IRCv3 message tag value"""
+	if '\\' not in value:
+		return value
+	out = []
+	i = 0
+	while i < len(value):
+		c = value[i]
+		if c == '\\':
+			i += 1
+			if i < len(value):
+				out.append(_TAG_ESCAPES.get(value[i], value[i]))
+		else:
+			out.append(c)
+		i += 1
+	return ''.join(out)
+
+class _LogWriter(logging.Handler):
+	"""
+	Log handler that only puts records in a ring buffer. A background thread formats them and writes them out in batches.
+	When the buffer is full the oldest record is dropped, so logging never blocks a bot.
+	"""
+	def __init__(self, stream, size, *args, **kwargs):
+		super(_LogWriter, self).__init__(*args, **kwargs)
+		
+		self._stream = stream
+		# Log records, or (time, direction, line) tuples for sent and received lines
+		self._records = collections.deque(maxlen=max(1, size))
+		self._cond = threading.Condition()
+		self._quit = False
+		self.dropped = 0
+		
+		self._thread = threading.Thread(target=self._run)
+		self._thread.daemon = True
+		self._thread.start()
+	
+	def emit(self, record):
+		self._put(record)
+	
+	def _put(self, item):
+		with self._cond:
+			if len(self._records) == self._records.maxlen:
+				self.dropped += 1
+			self._records.append(item)
+			if len(self._records) == 1:
+				self._cond.notify()
+	
+	def _run(self):
+		while True:
+			with self._cond:
+				while not self._records and not self._quit:
+					self._cond.wait()
+				if not self._records:
+					return
+				items = self._records
+				self._records = collections.deque(maxlen=items.maxlen)
+			out = []
+			for item in items:
+				if isinstance(item, tuple):
+					created, direction, line = item
+					record = logging.LogRecord(_log.name, logging.DEBUG, '', 0, '%s: %s', (direction, line), None)
+					record.created = created
+					item = record
+				try:
+					out.append(self.format(item))
+				except Exception:
+					self.handleError(item)
+			try:
+				self._stream.write('\n'.join(out) + '\n')
+				self._stream.flush()
+			except Exception:
+				pass
+	
+	def close(self):
+		with self._cond:
+			self._quit = True
+			self._cond.notify()
+		self._thread.join()
+		super(_LogWriter, self).close()
+
+# Handler installed by startLogging
+_logWriter = None
+_logLock = threading.Lock()
+# Received lines are logged one in every _recvSample
+_recvSample = 1
+_recvCount = 0
+
+def startLogging(stream=None, filename=None, level=logging.DEBUG, bufferSize=10000, recvSample=1, logFormat='%(asctime)s %(levelname)s %(message)s', propagate=False):
+	"""
+	Writes the log of all bots to a stream or a file from a background thread, so slow output never holds up a bot.
+	Records wait in a ring buffer. When the writer cannot keep up, the oldest records are dropped.
+	Bots connected with verbose=True call this with the defaults and propagate=True, unless a handler is already configured for the 'pythonircbot' logger or one of its ancestors (e.g. by logging.basicConfig()).
+	
+	Arguments:
+	- stream: Stream to write to. Standard output if neither stream nor filename is given.
+	- filename: File to append the log to
+	- level: Lowest level written. Sent and received lines are DEBUG, notes are INFO, problems are WARNING and up.
+	- bufferSize: Maximum number of records waiting to be written
+	- recvSample: Log only one in every recvSample received lines. 1 logs them all.
+	- logFormat: Format of a line, see the logging module
+	- propagate: Also pass records on to the handlers of ancestor loggers, like the root logger
+	
+	Returns False if logging was already started.
+	"""
+	global _logWriter, _recvSample
+	with _logLock:
+		if _logWriter is not None:
+			return False
+		if filename is not None:
+			stream = open(filename, 'a', encoding='utf-8')
+		elif stream is None:
+			stream = sys.stdout
+		_logWriter = _LogWriter(stream, bufferSize)
+		_logWriter.setFormatter(logging.Formatter(logFormat))
+		_recvSample = max(1, recvSample)
+		_log.addHandler(_logWriter)
+		_log.setLevel(level)
+		_log.propagate = propagate
+		return True
+
+def stopLogging():
+	"""
+	Writes out the records still in the buffer and stops the background writer.
+	"""
+	global _logWriter
+	with _logLock:
+		if _logWriter is None:
+			return
+		_log.removeHandler(_logWriter)
+		_logWriter.close()
+		_logWriter = None
+
+atexit.register(stopLogging)
+
+def _logLine(direction, line):
+	# Sent and received lines skip building a log record, the writer thread does that, unless the root logger has handlers that should see them too
+	writer = _logWriter
+	if writer is not None and _log.level <= logging.DEBUG and (not _log.propagate or not logging.root.handlers):
+		writer._put((time.time(), direction, line))
+	else:
+		_log.debug("%s: %s", direction, line)
+
+def _logRecv(line):
+	# The counter is shared by all bots and not locked, so sampling is only roughly one in _recvSample
+	global _recvCount
+	_recvCount += 1
+	if _recvCount >= _recvSample:
+		_recvCount = 0
+		_logLine('RECV', line)
+
+class Message(object):
+	"""
+	A single IRC line, parsed once on the receive thread and shared by all handlers.
+	
+	Attributes:
+	- raw: The line as it was received
+	- prefix: Source of the message (nick!user@host or server name), '' if absent
+	- command: Upper-cased command or numeric
+	- params: List of parameters, including the trailing parameter
+	- trailing: The trailing parameter, or None if the line had none
+	
+	The source parts (nick, user, host, client) and the IRCv3 tags are decoded on first access.
+	"""
+	__slots__ = ('raw', 'prefix', 'command', 'params', 'trailing', '_tags', '_nick', '_user', '_host')
+	
+	def __init__(self, line):
+		self.raw = line
+		self._tags = None
+		self._nick = None
+		if line[:1] == '@':
+			self._tags, _, line = line[1:].partition(' ')
+		self.prefix = ''
+		if line[:1] == ':':
+			self.prefix, _, line = line[1:].partition(' ')
+		self.trailing = None
+		i = line.find(' :')
+		if i != -1:
+			line, self.trailing = line[:i], line[i + 2:]
+		elif line[:1] == ':':
+			line, self.trailing = '', line[1:]
+		self.params = line.split()
+		self.command = self.params.pop(0).upper() if self.params else ''
+		if self.trailing is not None:
+			self.params.append(self.trailing)
+	
+	def _splitPrefix(self):
+		nick, _, host = self.prefix.partition('@')
+		nick, _, user = nick.partition('!')
+		self._nick = nick
+		self._user = user
+		self._host = host
+	
+	@property
+	def nick(self):
+		"""Nickname (or server name) of the source"""
+		if self._nick is None:
+			self._splitPrefix()
+		return self._nick
+	
+	@property
+	def user(self):
+		"""Username of the source, '' if unknown"""
+		if self._nick is None:
+			self._splitPrefix()
+		return self._user
+	
+	@property
+	def host(self):
+		"""Hostname of the source, '' if unknown"""
+		if self._nick is None:
+			self._splitPrefix()
+		return self._host
+	
+	@property
+	def client(self):
+		"""user@host of the source, as passed to handlers as client"""
+		return self.prefix.partition('!')[2]
+	
+	@property
+	def tags(self):
+		"""Dictionary of IRCv3 message tags. Tags without a value map to ''."""
+		if not isinstance(self._tags, dict):
+			tags = dict()
+			if self._tags:
+				for tag in self._tags.split(';'):
+					key, _, value = tag.partition('=')
+					if key:
+						tags[key] = _unescapeTag(value)
+			self._tags = tags
+		return self._tags
+	
+	def __repr__(self):
+		return 'Message({!r})'.format(self.raw)
 
 class _PyEvent(object):
 	"""Own internal event implementation"""
@@ -54,82 +335,699 @@ class _PyEvent(object):
 	def connect(self, func):
 		self.subscribers.append(func)
 
-class _SuperSocket(object):
-	"""Socket with flooding control"""
-	def __init__(self, sleepTime, maxItems, verbose=True, *args, **kwargs):
-		super(_SuperSocket, self).__init__(*args, **kwargs)
+class _LineFramer(object):
+	"""Buffers raw socket data and hands out complete, decoded lines"""
+	_MIN_READ = 4096
+	_MAX_READ = 65536
+	
+	def __init__(self, maxLineLength=16384, *args, **kwargs):
+		super(_LineFramer, self).__init__(*args, **kwargs)
+		
+		self._buffer = bytearray()
+		self._maxLineLength = maxLineLength
+		# Set while dropping a runaway line, until its terminating LF arrives
+		self._discarding = False
+		# Suggested size for the next read
+		self.readSize = self._MIN_READ
+	
+	def feed(self, data):
+		"""
+		Adds received bytes to the buffer and returns a list of the complete lines in it.
+		Lines are split on LF with an optional preceding CR. An unterminated tail is kept for the next call.
+		Lines longer than maxLineLength bytes are dropped whole.
+		"""
+		# Grow the read size while reads fill it (NAMES bursts, netjoins), shrink back when idle
+		if len(data) >= self.readSize and self.readSize < self._MAX_READ:
+			self.readSize *= 2
+		elif len(data) < self.readSize // 4 and self.readSize > self._MIN_READ:
+			self.readSize //= 2
+		
+		buf = self._buffer
+		buf += data
+		end = buf.rfind(b'\n')
+		if end == -1:
+			if len(buf) > self._maxLineLength:
+				# Runaway line without a terminator, drop what we have and the rest of it up to the next LF
+				del buf[:]
+				self._discarding = True
+			return []
+		
+		lines = []
+		start = 0
+		if self._discarding:
+			start = buf.find(b'\n') + 1
+			self._discarding = False
+		maxLineLength = self._maxLineLength
+		view = memoryview(buf)
+		try:
+			while start <= end:
+				i = buf.find(b'\n', start, end + 1)
+				stop = i
+				if stop > start and buf[stop - 1] == 13:
+					stop -= 1
+				if start < stop <= start + maxLineLength:
+					lines.append(str(view[start:stop], errors='ignore'))
+				start = i + 1
+		finally:
+			view.release()
+		del buf[:end + 1]
+		return lines
+
+class _TokenBucket(object):
+	"""Token bucket used for flood control: allows a burst of lines, then refills at a steady rate"""
+	def __init__(self, rate, burst, *args, **kwargs):
+		super(_TokenBucket, self).__init__(*args, **kwargs)
+		
+		self._rate = rate
+		self._burst = max(1, burst)
+		self._tokens = float(self._burst)
+		self._last = time.monotonic()
+	
+	def delay(self):
+		"""Returns the seconds to wait before the next line may be sent. Takes a token when this is 0."""
+		if self._rate <= 0:
+			return 0.0
+		now = time.monotonic()
+		self._tokens = min(self._burst, self._tokens + (now - self._last) * self._rate)
+		self._last = now
+		if self._tokens >= 1:
+			self._tokens -= 1
+			return 0.0
+		return (1 - self._tokens) / self._rate
+
+class _LaneQueue(object):
+	"""Outgoing message queue with one FIFO lane per priority. Higher priority lanes are always emptied first."""
+	def __init__(self, maxItems=0, *args, **kwargs):
+		super(_LaneQueue, self).__init__(*args, **kwargs)
+		
+		self._lanes = [collections.deque() for i in range(PRIORITY_BULK + 1)]
+		self._maxItems = maxItems
+		self._size = 0
+		self._cond = threading.Condition()
+	
+	def __len__(self):
+		return self._size
+	
+	def put(self, item, priority=PRIORITY_NORMAL):
+		"""
+		Queues item. Protocol lines are never dropped.
+		When maxItems is reached, the newest item of the lowest priority lane below item's priority is dropped to make room.
+		Raises queue.Full if there is no such item.
+		"""
+		with self._cond:
+			if self._maxItems > 0 and self._size >= self._maxItems and priority != PRIORITY_PROTOCOL:
+				for lane in reversed(self._lanes[priority + 1:]):
+					if lane:
+						lane.pop()
+						self._size -= 1
+						if _log.isEnabledFor(logging.INFO):
+							_log.info("Message queue full, dropped a lower priority line.")
+						break
+				else:
+					raise queue.Full
+			self._lanes[priority].append(item)
+			self._size += 1
+			self._cond.notify()
+	
+	def wait(self, timeout=None):
+		"""Blocks until an item is available. Returns False on timeout."""
+		with self._cond:
+			return self._cond.wait_for(self.__len__, timeout)
+	
+	def get_nowait(self):
+		"""Returns the oldest item of the highest priority lane. Raises queue.Empty if there is none."""
+		with self._cond:
+			for lane in self._lanes:
+				if lane:
+					self._size -= 1
+					return lane.popleft()
+		raise queue.Empty
+
+# Seconds to wait for a single connection attempt, and the bounds of the backoff between attempts
+_CONNECT_TIMEOUT = 15
+_RECONNECT_MIN = 2
+_RECONNECT_MAX = 300
+
+def _backoffDelay(attempt):
+	"""Seconds to wait after the given failed connection attempt: capped exponential backoff with full jitter"""
+	return random.uniform(_RECONNECT_MIN / 2.0, min(_RECONNECT_MAX, _RECONNECT_MIN * 2 ** min(attempt, 16)))
+
+def _floodRate(sleepTime):
+	# Lines per second for a given average spacing; 0 disables flood control
+	return 1.0 / sleepTime if sleepTime > 0 else 0
+
+class _BaseSocket(object):
+	"""Outgoing queue, flood control, connecting and teardown shared by the thread, SelectorLoop and asyncio sockets"""
+	def __init__(self, sleepTime, maxItems, verbose=True, burst=4, *args, **kwargs):
+		super(_BaseSocket, self).__init__(*args, **kwargs)
 		
 		self._sleepTime = sleepTime
+		self._bucket = _TokenBucket(_floodRate(sleepTime), burst)
 		self._maxItems = maxItems
 		self._verbose = verbose
-		self._messageQueue = queue.Queue(self._maxItems)
+		self._messageQueue = _LaneQueue(self._maxItems)
 		self._quit = False
 		
 		self._shutdownEvent = _PyEvent()
 		
-		self._s = socket.socket()
+		self._s = None
+		self._framer = _LineFramer()
 	
+	def _openSocket(self, host, port, timeout=_CONNECT_TIMEOUT):
+		"""Tries every address the host resolves to once. Returns the connected socket, or None."""
+		if self._verbose:
+			_log.info("Trying to connect...")
+		try:
+			addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+		except socket.error:
+			return None
+		for family, socktype, proto, canonname, address in addresses:
+			s = socket.socket(family, socktype, proto)
+			try:
+				s.settimeout(timeout)
+				s.connect(address)
+			except socket.error:
+				s.close()
+				continue
+			return s
+		return None
+	
+	def _send(self, data, priority=PRIORITY_NORMAL):
+		try:
+			self._messageQueue.put(data, priority)
+		except queue.Full:
+			if self._verbose:
+				_log.warning("Message queue full.")
+			return
+		self._queued()
+	
+	def _queued(self):
+		# Called after a line was queued, to wake whatever sends the lines
+		pass
+	
+	def _closeSocket(self):
+		if self._s is None:
+			return
+		try:
+			# Wakes up a receive thread that is still blocked in recv()
+			self._s.shutdown(socket.SHUT_RDWR)
+		except socket.error:
+			pass
+		self._s.close()
+	
+	def _die(self):
+		# Several parts of a connection may notice it died, only report it once
+		if self._quit:
+			return
+		if self._verbose:
+			_log.warning("Socket dead. Going to reconnect.")
+		self._quit = True
+		self._dying()
+		self._shutdownEvent.emit()
+	
+	def _dying(self):
+		# Called once when the connection died, before the bot is told
+		pass
+
+class _SuperSocket(_BaseSocket):
+	"""Socket with flooding control, written to by a sender thread of its own"""
 	def _senderThread(self):
 		while not self._quit:
 			# Block until item is available (might not happen when disconnected, then this thread is a zombie)
 			try:
-				data = self._messageQueue.get(True, 5)
+				if not self._messageQueue.wait(5):
+					continue
+				# Flood control. The line is picked after waiting, so a PONG queued meanwhile goes first.
+				wait = self._bucket.delay()
+				while wait > 0:
+					time.sleep(wait)
+					wait = self._bucket.delay()
+				data = self._messageQueue.get_nowait()
 				data = data + "\r\n"
 				self._s.send(data.encode())
 				if self._verbose:
-					print("SENT: ", data)
-				time.sleep(self._sleepTime)
+					_logLine('SENT', data.rstrip())
 			except queue.Empty:
 				pass
 			except:
 				self._die()
 	
-	def _connect(self, host, port):
-		# Try to connect over and over until it worked
-		try:
-			if self._verbose:
-				print("NOTE:\tTrying to connect...")
-			self._s.connect((host, port))
-			# Start the sender thread
-			t = threading.Thread(target=self._senderThread)
-			t.daemon = True
-			t.start()
-		except:
-			time.sleep(5)
-			self._connect(host, port)
-	
-	def _send(self, data):
-		try:
-			self._messageQueue.put(data, False)
-		except queue.Full:
-			if self._verbose:
-				print("NOTE:\tMessage queue full.")
+	def _connect(self, host, port, timeout=_CONNECT_TIMEOUT):
+		"""Tries every address the host resolves to once. Returns True and starts the sender thread on success."""
+		s = self._openSocket(host, port, timeout)
+		if s is None:
+			return False
+		s.settimeout(None)
+		self._s = s
+		# Start the sender thread
+		t = threading.Thread(target=self._senderThread)
+		t.daemon = True
+		t.start()
+		return True
 	
 	def _recv(self):
+		"""Blocks until data arrives and returns the complete lines received so far, or None if the socket died"""
 		try:
-			data = self._s.recv(4096)
-			data = data.decode(errors='ignore')
-			if not data:
-				self._die()
-			else:
-				data = data.rstrip('\r\n')
-				return data
+			data = self._s.recv(self._framer.readSize)
 		except socket.error:
 			self._die()
+			return None
+		if not data:
+			self._die()
+			return None
+		return self._framer.feed(data)
 	
 	def _close(self):
-		self._s.close()
+		self._quit = True
+		self._closeSocket()
+
+class _LoopSocket(_BaseSocket):
+	"""Socket with flooding control that is driven by a SelectorLoop instead of threads of its own"""
+	def __init__(self, loop, sleepTime, maxItems, verbose=True, burst=4, *args, **kwargs):
+		super(_LoopSocket, self).__init__(sleepTime, maxItems, verbose, burst, *args, **kwargs)
+		
+		self._loop = loop
+		self._receiver = None
+		# Encoded lines taken from the queue that the socket did not accept yet
+		self._out = b''
+		self._writing = False
 	
-	def _die(self):
-		if self._verbose:
-			print("NOTE:\tSocket dead. Going to reconnect.")
+	def _connect(self, host, port, timeout=_CONNECT_TIMEOUT):
+		"""Tries every address the host resolves to once. Returns True on success. Nothing is received until _start is called."""
+		s = self._openSocket(host, port, timeout)
+		if s is None:
+			return False
+		s.setblocking(False)
+		self._s = s
+		return True
+	
+	def _start(self, receiver):
+		"""Hands the socket to the loop, which passes every line received to receiver"""
+		self._receiver = receiver
+		self._loop._callSoon(lambda: self._loop._add(self))
+	
+	def _queued(self):
+		self._loop._wake()
+	
+	def _close(self):
 		self._quit = True
-		self._shutdownEvent.emit()
+		self._loop._callSoon(lambda: self._loop._remove(self))
+	
+	def _dying(self):
+		# Runs on the loop thread
+		self._loop._remove(self)
+		self._receiver._die()
+	
+	def _onReadable(self):
+		try:
+			data = self._s.recv(self._framer.readSize)
+		except (BlockingIOError, InterruptedError):
+			return
+		except socket.error:
+			self._die()
+			return
+		if not data:
+			self._die()
+			return
+		for line in self._framer.feed(data):
+			if self._verbose:
+				_logRecv(line)
+			self._receiver._handleLine(line)
+	
+	def _flush(self):
+		"""Writes queued lines as far as flood control allows. Returns the seconds until the next line may be written, or None."""
+		if self._quit:
+			return None
+		wait = None
+		# New lines are only taken once the socket accepted the previous ones, so later high priority lines can still go first
+		if not self._out:
+			while len(self._messageQueue):
+				wait = self._bucket.delay()
+				if wait > 0:
+					break
+				wait = None
+				data = self._messageQueue.get_nowait() + "\r\n"
+				self._out += data.encode()
+				if self._verbose:
+					_logLine('SENT', data.rstrip())
+		if self._out:
+			try:
+				sent = self._s.send(self._out)
+			except (BlockingIOError, InterruptedError):
+				sent = 0
+			except socket.error:
+				self._die()
+				return None
+			self._out = self._out[sent:]
+		# Only ask to be told about a writable socket while there is something waiting for it
+		if bool(self._out) != self._writing:
+			self._writing = bool(self._out)
+			self._loop._selector.modify(self._s, selectors.EVENT_READ | (selectors.EVENT_WRITE if self._writing else 0), self)
+		return wait
 
-class _BotReceiveThread(threading.Thread):
-	"""Thread in which the bot handles received messages"""
+class SelectorLoop(object):
+	"""
+	Runs the connections of many bots on a single thread, using the best selector the platform has (epoll, kqueue, ...).
+	Every connection keeps its own flood control, and threaded handlers of all bots run on one shared pool.
+	Handlers registered with thread=False run on the loop thread, so they hold up every bot on the loop while they run.
+	"""
+	def __init__(self, handlerWorkers=8, handlerQueueSize=1000, handlerSaturation='drop', handlerOrdered=False, verbose=True, *args, **kwargs):
+		"""
+		Creates a loop. It starts itself on a new thread when the first bot connects with it.
+		
+		Arguments:
+		- handlerWorkers: Number of worker threads shared by the bots on this loop
+		- handlerQueueSize: Maximum number of handler calls waiting for a worker. 0 means unlimited.
+		- handlerSaturation: What to do when the queue is full: 'drop' the call (logged as a warning), or run it on the 'caller' (the loop thread). The loop thread never waits for room, so 'block' acts like 'drop' for calls made from it.
+		- handlerOrdered: If True, handlers for the same channel run one after the other, in the order the lines arrived
+		- verbose: If True, logs notes about the loop
+		"""
+		super(SelectorLoop, self).__init__(*args, **kwargs)
+		
+		self._handlerPool = _HandlerPool(handlerWorkers, handlerQueueSize, handlerSaturation, handlerOrdered)
+		self._verbose = verbose
+		self._selector = selectors.DefaultSelector()
+		self._sockets = set()
+		self._thread = None
+		self._quit = False
+		
+		# Other threads queue calls here and wake the loop up through a socket pair
+		self._calls = collections.deque()
+		self._lock = threading.Lock()
+		self._woken = False
+		self._wakeReader, self._wakeWriter = socket.socketpair()
+		self._wakeReader.setblocking(False)
+		self._wakeWriter.setblocking(False)
+		self._selector.register(self._wakeReader, selectors.EVENT_READ, None)
+	
+	def start(self):
+		"""
+		Starts the loop on a new thread, unless it is already running.
+		"""
+		with self._lock:
+			if self._thread is not None:
+				return
+			self._thread = threading.Thread(target=self.run)
+			self._thread.daemon = True
+			self._thread.start()
+	
+	def stop(self):
+		"""
+		Stops the loop. Connections still on it are left open.
+		"""
+		self._quit = True
+		self._wake()
+	
+	def run(self):
+		"""
+		Runs the loop on the calling thread until stop is called.
+		"""
+		while not self._quit:
+			timeout = None
+			for s in list(self._sockets):
+				try:
+					wait = s._flush()
+				except Exception:
+					_log.exception("Error sending on a loop connection.")
+					s._die()
+					continue
+				if wait is not None and (timeout is None or wait < timeout):
+					timeout = wait
+			
+			for key, events in self._selector.select(timeout):
+				if key.data is None:
+					self._runCalls()
+					continue
+				if events & selectors.EVENT_READ:
+					try:
+						key.data._onReadable()
+					except Exception:
+						_log.exception("Error receiving on a loop connection.")
+						key.data._die()
+	
+	def _wake(self):
+		# Makes select() return, so queued lines and calls are seen
+		with self._lock:
+			if self._woken:
+				return
+			self._woken = True
+		try:
+			self._wakeWriter.send(b'\0')
+		except socket.error:
+			pass
+	
+	def _callSoon(self, function):
+		# Runs function on the loop thread
+		with self._lock:
+			self._calls.append(function)
+		self.start()
+		self._wake()
+	
+	def _runCalls(self):
+		try:
+			while self._wakeReader.recv(4096):
+				pass
+		except socket.error:
+			pass
+		with self._lock:
+			self._woken = False
+			calls = list(self._calls)
+			self._calls.clear()
+		for function in calls:
+			try:
+				function()
+			except Exception:
+				_log.exception("Error in a call on the loop thread.")
+	
+	def _add(self, s):
+		if s._quit:
+			# Closed before the loop got to it, so _remove had nothing to unregister
+			s._closeSocket()
+			return
+		self._sockets.add(s)
+		self._selector.register(s._s, selectors.EVENT_READ, s)
+	
+	def _remove(self, s):
+		if s in self._sockets:
+			self._sockets.discard(s)
+			self._selector.unregister(s._s)
+		s._closeSocket()
+
+# Maximum length of an IRC line in bytes, without the CR LF
+_MAX_LINE = 510
+# Assumed length of our username and hostname until the server has shown them to us
+_MAX_USER = 10
+_MAX_HOST = 63
+
+# Only real line breaks; str.splitlines() would also split on formatting codes such as \x1d (italics)
+_LINE_BREAK_RE = re.compile('\r\n|\r|\n')
+
+def _splitText(text, budget):
+	"""
+	Splits text into lines of at most budget UTF-8 bytes.
+	Breaks at the last space that fits, or else at a character boundary. Embedded line breaks start a new line.
+	"""
+	lines = []
+	budget = max(budget, 4)
+	for part in _LINE_BREAK_RE.split(text):
+		data = part.encode()
+		while len(data) > budget:
+			cut = data.rfind(b' ', 0, budget + 1)
+			if cut <= 0:
+				cut = budget
+				# Don't cut into a multi-byte character
+				while cut > 0 and (data[cut] & 0xC0) == 0x80:
+					cut -= 1
+			lines.append(data[:cut].decode())
+			data = data[cut:].lstrip(b' ')
+		if data or not lines:
+			lines.append(data.decode())
+	return lines
+
+def _joinLines(channels, maxTargets=0):
+	"""Packs (channel, key) pairs into JOIN lines of at most maxTargets channels (0 for no limit) that fit in one IRC line"""
+	lines = []
+	names = []
+	keys = []
+	length = 0
+	for channel, key in channels:
+		extra = len(channel.encode()) + len(key.encode()) + 2
+		if names and ((maxTargets and len(names) >= maxTargets) or length + extra > _MAX_LINE - len("JOIN  ")):
+			lines.append(_joinLine(names, keys))
+			names = []
+			keys = []
+			length = 0
+		names.append(channel)
+		if key:
+			keys.append(key)
+		length += extra
+	if names:
+		lines.append(_joinLine(names, keys))
+	return lines
+
+def _joinLine(names, keys):
+	if keys:
+		return "JOIN {} {}".format(','.join(names), ','.join(keys))
+	return "JOIN {}".format(','.join(names))
+
+class _HandlerPool(object):
+	"""Bounded pool of worker threads that runs threaded handlers"""
+	def __init__(self, workers=8, maxPending=1000, saturation='drop', ordered=False, *args, **kwargs):
+		super(_HandlerPool, self).__init__(*args, **kwargs)
+		
+		if saturation not in ('block', 'drop', 'caller'):
+			raise ValueError("saturation must be 'block', 'drop' or 'caller'")
+		self._workers = max(1, workers)
+		self._saturation = saturation
+		# Ordered pools give every worker its own queue, so calls with the same key run in order on one worker
+		self._queues = [queue.Queue(maxPending) for i in range(self._workers if ordered else 1)]
+		self._threads = []
+		self._lock = threading.Lock()
+	
+	def submit(self, function, args, key=None, mayBlock=True):
+		"""
+		Queues function(*args) to run on a worker. Returns False if the call was dropped.
+		
+		Arguments:
+		- function: Function to call
+		- args: Tuple of arguments
+		- key: Ordering key (the channel). Calls with the same key keep their order in an ordered pool.
+		- mayBlock: False when called from a thread that must never wait, like a SelectorLoop or asyncio loop. A 'block' pool then drops the call instead.
+		"""
+		if not self._threads:
+			self._start()
+		
+		if len(self._queues) == 1:
+			q = self._queues[0]
+		else:
+			q = self._queues[hash(key.lower() if isinstance(key, str) else key) % len(self._queues)]
+		
+		if self._saturation == 'block' and mayBlock:
+			q.put((function, args))
+			return True
+		try:
+			q.put_nowait((function, args))
+			return True
+		except queue.Full:
+			if self._saturation == 'caller':
+				self._call(function, args)
+				return True
+			_log.warning("Handler queue full. Dropping handler call.")
+			return False
+	
+	def _start(self):
+		with self._lock:
+			if self._threads:
+				return
+			for i in range(self._workers):
+				t = threading.Thread(target=self._worker, args=(self._queues[i % len(self._queues)],))
+				t.daemon = True
+				t.start()
+				self._threads.append(t)
+	
+	def _worker(self, q):
+		while True:
+			function, args = q.get()
+			self._call(function, args)
+	
+	def _call(self, function, args):
+		try:
+			function(*args)
+		except Exception:
+			_log.exception("Handler raised an exception.")
+
+# Mode changes per MODE line when the server does not advertise MODES (RFC 1459 default), and when it sets no limit
+_DEFAULT_MODES = 3
+_UNLIMITED_MODES = 12
+# Room left for the mode changes in a MODE line, after the command, channel and the server's source prefix
+_MAX_MODE_LINE = 400
+
+class _ModeBatcher(object):
+	"""Collects mode changes per channel and sends them as multi-mode MODE lines (MODE #chan +vv-o a b c)"""
+	def __init__(self, send, window=0.2, *args, **kwargs):
+		super(_ModeBatcher, self).__init__(*args, **kwargs)
+		
+		self._send = send
+		self._window = window
+		self._maxModes = _DEFAULT_MODES
+		self._pending = collections.OrderedDict()
+		self._lock = threading.Lock()
+		self._timer = None
+	
+	def add(self, channel, sign, mode, arg):
+		"""Queues a mode change. Full batches are sent right away, the rest after the batching window."""
+		lines = []
+		with self._lock:
+			key = channel.upper()
+			if key not in self._pending:
+				self._pending[key] = (channel, [])
+			changes = self._pending[key][1]
+			changes.append((sign, mode, arg))
+			if len(changes) >= self._maxModes:
+				del self._pending[key]
+				lines = self._format(channel, changes)
+			elif self._timer is None:
+				self._timer = threading.Timer(self._window, self.flush)
+				self._timer.daemon = True
+				self._timer.start()
+		for line in lines:
+			self._send(line)
+	
+	def flush(self):
+		"""Sends all pending mode changes now."""
+		with self._lock:
+			if self._timer is not None:
+				self._timer.cancel()
+				self._timer = None
+			pending = list(self._pending.values())
+			self._pending.clear()
+		for channel, changes in pending:
+			for line in self._format(channel, changes):
+				self._send(line)
+	
+	def _format(self, channel, changes):
+		lines = []
+		i = 0
+		while i < len(changes):
+			modes = ''
+			args = []
+			sign = ''
+			length = 0
+			while i < len(changes) and len(args) < self._maxModes:
+				changeSign, mode, arg = changes[i]
+				if args and length + len(arg) + 3 > _MAX_MODE_LINE:
+					break
+				if changeSign != sign:
+					modes += changeSign
+					sign = changeSign
+				modes += mode
+				args.append(arg)
+				length += len(arg) + 3
+				i += 1
+			lines.append("MODE {} {} {}".format(channel, modes, ' '.join(args)))
+		return lines
+
+class _Channel(object):
+	"""
+	Members and topic of a joined channel.
+	The bot keeps one live copy per channel that only the receive thread changes, and hands out copies to readers.
+	"""
+	__slots__ = ('members', 'nicks', 'topic')
+	
+	def __init__(self, members=None, nicks=None, topic=None):
+		# Casefolded nick -> bitmask of prefix modes, bit i being mode i of ISUPPORT PREFIX
+		self.members = dict() if members is None else members
+		# Casefolded nick -> nick as the server spelled it
+		self.nicks = dict() if nicks is None else nicks
+		self.topic = topic
+	
+	def _copy(self):
+		return _Channel(dict(self.members), dict(self.nicks), self.topic)
+
+class _BotReceiver(object):
+	"""Parses received lines and dispatches them to the bot"""
 	def __init__(self, bot, verbose=True, *args, **kwargs):
-		super(_BotReceiveThread, self).__init__(*args, **kwargs)
+		super(_BotReceiver, self).__init__(*args, **kwargs)
 		
 		self._bot = bot
 		self._verbose = verbose
@@ -139,301 +1037,344 @@ class _BotReceiveThread(threading.Thread):
 		self._shutdownEvent = threading.Event()
 		# Event to fire when channel was joined
 		self._joinedEvent = _PyEvent()
-		# Event to fire when channel was parted
+		# Event to fire when channel was parted, or a user was kicked from it
 		self._partedEvent = _PyEvent()
-		# Event to fire when the list of names has been updated
+		# Event to fire when a user quit
+		self._quitEvent = _PyEvent()
+		# Event to fire when a user changed nick
+		self._nickEvent = _PyEvent()
+		# Event to fire when a NAMES or WHO reply listed members of a channel
 		self._updateNames = _PyEvent()
+		# Event to fire when a NAMES or WHO reply for a channel ended
+		self._namesEnd = _PyEvent()
 		# Event to fire when the channel topic has changed
 		self._updateTopic = _PyEvent()
 		# Event to fire when a user mode was set
 		self._userModeSet = _PyEvent()
 		# Event to fire when a user mode was unset
 		self._userModeUnset = _PyEvent()
+		# Event to fire when the server advertised its features (005 RPL_ISUPPORT)
+		self._updateISupport = _PyEvent()
+		# Event to fire when a registration step completed ('welcome', 'ready' or 'identified')
+		self._registrationStep = _PyEvent()
+		
+		# Command -> handler dispatch table
+		self._handlers = {
+			'PRIVMSG': self._privMsg,
+			'JOIN': self._joinChannel,
+			'PART': self._partChannel,
+			'QUIT': self._quitM,
+			'KICK': self._kick,
+			'NICK': self._nickM,
+			'MODE': self._mode,
+			'PING': self._pong,
+			'353': self._names,
+			'366': self._endOfNames,
+			'352': self._who,
+			'315': self._endOfNames,
+			'332': self._topic,
+			'005': self._isupport,
+			'001': self._welcome,
+			'376': self._endOfMotd,
+			'422': self._endOfMotd,
+			'900': self._loggedIn,
+			'NOTICE': self._notice,
+		}
 	
-	def run(self):
-		while not self._quit:
+	def _handleLine(self, line):
+		message = Message(line)
+		handler = self._handlers.get(message.command)
+		if handler is not None:
 			try:
-				lines = self._bot._s._recv().splitlines()
-			except AttributeError:
-				self._die()
-			
-			for line in lines:
-				if self._verbose:
-					try:
-						print("RECV: ", line)
-					except:
-						print("Error processing character")
-				
-				if self._privMsg(line):
-					continue
-				if self._joinChannel(line):
-					continue
-				if self._partChannel(line):
-					continue
-				if self._pong(line):
-					continue
-				if self._quitM(line):
-					continue
-				if self._modeset(line):
-					continue
-				if self._modeunset(line):
-					continue
-				if self._names(line):
-					continue
-				#if self._topic(line):
-					#continue
+				handler(message)
+			except Exception:
+				_log.exception("Error handling %s line.", message.command)
 	
 	def _die(self):
 		self._quit = True
 		self._shutdownEvent.set()
 	
-	def _joinChannel(self, line):
-		matchJoin1 = re.compile('^:(.*)!(.*) JOIN :(.*)').search(line)
-		matchJoin2 = re.compile('^:(.*)!(.*) JOIN (.*)').search(line)
-		for joinMatch in [matchJoin1, matchJoin2]:
-			if joinMatch:
-				try:
-					self._joinedEvent.emit(joinMatch.group(1), joinMatch.group(3))
-					nick = joinMatch.group(1)
-					client = joinMatch.group(2)
-					channel = joinMatch.group(3)			
-					if nick != self._bot._nick:
-						with self._bot._responseFunctionsLock:
-							_joinResponseFunctions = copy.copy(self._bot._joinResponseFunctions)
-						
-						for func in _joinResponseFunctions:
-							if func['thread']:
-								t = threading.Thread(target=func['func'], args=(nick, client, channel))
-								t.start()
-							else:
-								func(nick, client, channel)
-					
-						# Return a string, just to make sure it doesn't return None
-						return "continue"
-				except:
-					continue
-			
-	def _partChannel(self, line):
-		matchPart1 = re.compile('^:(.*)!(.*) PART :(.*)').search(line)
-		matchPart2 = re.compile('^:(.*)!(.*) PART (.*)').search(line)
-		for partMatch in [matchPart1, matchPart2]:
-			if partMatch:
-				try:
-					self._partedEvent.emit(partMatch.group(1), partMatch.group(3))
-					nick = partMatch.group(1)
-					client = partMatch.group(2)
-					channel = partMatch.group(3)			
-					if nick != self._bot._nick:
-						with self._bot._responseFunctionsLock:
-							_partResponseFunctions = copy.copy(self._bot._partResponseFunctions)
-						
-						for func in _partResponseFunctions:
-							if func['thread']:
-								t = threading.Thread(target=func['func'], args=(nick, client, channel))
-								t.start()
-							else:
-								func(nick, client, channel)
-						
-						# Return a string, just to make sure it doesn't return None
-						return "continue"
-				except:
-					continue
+	def _joinChannel(self, message):
+		if '!' not in message.prefix or not message.params:
+			return
+		nick = message.nick
+		client = message.client
+		channel = message.params[0]
+		self._joinedEvent.emit(nick, channel, client)
+		if nick != self._bot._nick:
+			for func in self._bot._joinResponseFunctions:
+				args = self._bot._joinResponseFunction(func, nick, client, channel, message)
+				if args is not None:
+					self._bot._runHandler(func, args, channel)
+	
+	def _partChannel(self, message):
+		if '!' not in message.prefix or not message.params:
+			return
+		nick = message.nick
+		client = message.client
+		channel = message.params[0]
+		self._partedEvent.emit(nick, channel)
+		if nick != self._bot._nick:
+			for func in self._bot._partResponseFunctions:
+				args = self._bot._partResponseFunction(func, nick, client, channel, message)
+				if args is not None:
+					self._bot._runHandler(func, args, channel)
 	
-	def _quitM(self, line):
-		matchQuit = re.compile('^:{}!.* QUIT :'.format(self._bot._nick)).search(line)
-		matchQuit2 = re.compile('^:(.*)!(.*) QUIT :.*').search(line)
-		if matchQuit:
+	def _quitM(self, message):
+		if '!' not in message.prefix:
+			return
+		nick = message.nick
+		client = message.client
+		if nick == self._bot._nick:
 			self._die()
-		elif matchQuit2:
-			nick = matchQuit2.group(1)
-			client = matchQuit2.group(2)			
-			if nick != self._bot._nick:
-				with self._bot._responseFunctionsLock:
-					_partResponseFunctions = copy.copy(self._bot._partResponseFunctions)
-				
-				for func in _partResponseFunctions:
-					if func['thread']:
-						t = threading.Thread(target=func['func'], args=(nick, client, ""))
-						t.start()
-					else:
-						func(nick, client, "")
-				
-				# Return a string, just to make sure it doesn't return None
-				return "continue"			
-	
-	def _names(self, line):
-		matchNames = re.compile('^:.* 353 {} .* (.*) :(.*)'.format(self._bot._nick)).search(line)
-		if matchNames:
-			# Names list
-			channel = matchNames.group(1)
-			names = matchNames.group(2)
-			
-			ownerSet = set()
-			aopsSet = set()
-			opsSet = set()
-			hopsSet = set()
-			voicesSet = set()
-			namesSet = set()
-			
-			names = names.split(' ')
-			for name in names:
-				if name[0] == '@':
-					opsSet.add(name[1:])
-					namesSet.add(name[1:])
-				elif name[0] == '&':
-					aopsSet.add(name[1:])
-					namesSet.add(name[1:])
-				elif name[0] == '~':
-					ownerSet.add(name[1:])
-					namesSet.add(name[1:])
-				elif name[0] == '%':
-					hopsSet.add(name[1:])
-					namesSet.add(name[1:])				
-				elif name[0] == '+':
-					voicesSet.add(name[1:])
-					namesSet.add(name[1:])
-				else:
-					namesSet.add(name)
-			
-			self._updateNames.emit(channel, namesSet, opsSet, voicesSet, ownerSet, aopsSet, hopsSet)
+			return
+		self._quitEvent.emit(nick)
+		
+		for func in self._bot._partResponseFunctions:
+			args = self._bot._partResponseFunction(func, nick, client, "", message)
+			if args is not None:
+				self._bot._runHandler(func, args, nick)
 	
-	def _topic(self, line):
-		matchTopic = re.compile('^:.* 332 {} (.*) :(.*)'.format(self._bot._nick)).search(line)
-		if matchTopic:
-			channel = matchTopic.group(1)
-			topic = matchTopic.group(2)
-			
-			self._updateTopic.emit(channel, topic)
-	
-	def _privMsg(self, line):
-		matchPrivmsg = re.compile('^:(.*)!(.*) PRIVMSG (.*) :(.*)').search(line)
-		if matchPrivmsg:
-			# Privmsg
-			nick = matchPrivmsg.group(1)
-			client = matchPrivmsg.group(2)
-			channel = matchPrivmsg.group(3)
-			rmsg = matchPrivmsg.group(4)
-			
-			with self._bot._responseFunctionsLock:
-				_msgResponseFunctions = copy.copy(self._bot._msgResponseFunctions)
-			
-			for func in _msgResponseFunctions:
-				if func['thread']:
-					t = threading.Thread(target=func['func'], args=(rmsg, nick, client, channel))
-					t.start()
-				else:
-					func(rmsg, nick, client, channel)
+	def _kick(self, message):
+		# :source KICK <channel> <nick> [:<reason>]
+		params = message.params
+		if len(params) < 2:
+			return
+		self._partedEvent.emit(params[1], params[0])
+	
+	def _nickM(self, message):
+		# :old!user@host NICK <new>
+		if '!' not in message.prefix or not message.params:
+			return
+		self._nickEvent.emit(message.nick, message.params[0])
+	
+	def _names(self, message):
+		# :server 353 <me> <type> <channel> :<names>
+		params = message.params
+		if len(params) < 3 or params[0] != self._bot._nick:
+			return
+		self._updateNames.emit(params[-2], params[-1].split())
+	
+	def _who(self, message):
+		# :server 352 <me> <channel> <user> <host> <server> <nick> <flags> :<hopcount> <realname>
+		params = message.params
+		if len(params) < 7 or params[0] != self._bot._nick:
+			return
+		# Flags are H or G, then * for IRC operators, then the prefix symbols
+		symbols = ''.join(flag for flag in params[6] if flag in self._bot._prefixSymbols)
+		self._updateNames.emit(params[1], [symbols + params[5]])
+	
+	def _endOfNames(self, message):
+		# :server 366 <me> <channel> :End of /NAMES list
+		# :server 315 <me> <mask> :End of /WHO list
+		params = message.params
+		if len(params) < 2 or params[0] != self._bot._nick:
+			return
+		channel = params[1]
+		self._namesEnd.emit(channel)
+		for func in self._bot._namesResponseFunctions:
+			args = self._bot._namesResponseFunction(func, channel, message)
+			if args is not None:
+				self._bot._runHandler(func, args, channel)
+	
+	def _topic(self, message):
+		# :server 332 <me> <channel> :<topic>
+		params = message.params
+		if len(params) < 3 or params[0] != self._bot._nick:
+			return
+		self._updateTopic.emit(params[1], params[2])
+	
+	def _welcome(self, message):
+		# :server 001 <me> :Welcome ...
+		self._registrationStep.emit('welcome')
+	
+	def _endOfMotd(self, message):
+		# 376 RPL_ENDOFMOTD or 422 ERR_NOMOTD: registration is complete
+		self._registrationStep.emit('ready')
+	
+	def _loggedIn(self, message):
+		# 900 RPL_LOGGEDIN
+		self._registrationStep.emit('identified')
+	
+	def _notice(self, message):
+		# Services without SASL numerics confirm IDENTIFY with a notice
+		if message.nick.lower() == 'nickserv' and message.trailing is not None and _IDENTIFIED_RE.search(message.trailing):
+			self._registrationStep.emit('identified')
+	
+	def _isupport(self, message):
+		# :server 005 <me> <token>[=<value>] ... :are supported by this server
+		params = message.params
+		tokens = params[1:-1] if message.trailing is not None else params[1:]
+		if tokens:
+			self._updateISupport.emit(tokens)
+	
+	def _privMsg(self, message):
+		if '!' not in message.prefix or len(message.params) < 2:
+			return
+		nick = message.nick
+		client = message.client
+		channel = message.params[0]
+		rmsg = message.params[1]
+		
+		for func in self._bot._msgResponseFunctions:
+			args = self._bot._msgResponseFunction(func, rmsg, nick, client, channel, message)
+			if args is not None:
+				self._bot._runHandler(func, args, channel)
+	
+	def _pong(self, message):
+		if message.params:
+			self._bot._s._send("PONG {}".format(message.params[-1]), PRIORITY_PROTOCOL)
+	
+	def _mode(self, message):
+		# :source MODE <target> <modestring> [<args>...]
+		params = message.params
+		if len(params) < 3:
+			return
+		channel = params[0]
+		args = params[2:]
+		sign = '+'
+		for mode in params[1]:
+			if mode in '+-':
+				sign = mode
+				continue
+			if mode not in self._bot._paramModes and not (sign == '+' and mode in self._bot._paramModesSet):
+				continue
+			if not args:
+				break
+			nick = args.pop(0)
+			if sign == '+':
+				self._userModeSet.emit(channel, nick, mode)
+			else:
+				self._userModeUnset.emit(channel, nick, mode)
+			for func in self._bot._modeResponseFunctions:
+				handlerArgs = self._bot._modeResponseFunction(func, channel, nick, mode, sign, message)
+				if handlerArgs is not None:
+					self._bot._runHandler(func, handlerArgs, channel)
+
+class _BotReceiveThread(_BotReceiver, threading.Thread):
+	"""Thread in which the bot handles received messages"""
+	def run(self):
+		while not self._quit:
+			lines = self._bot._s._recv()
+			if lines is None:
+				self._die()
+				break
 			
-			# Return a string, just to make sure it doesn't return None
-			return "continue"
-	
-	def _pong(self, line):
-		matchPing = re.compile('^PING :(.*)').search(line)
-		if matchPing:
-			# Ping
-			self._bot._s._send("PONG {}".format(matchPing.group(1)))
-			return "continue"
-	
-	def _modeset(self, line):
-		matchModeset = re.compile('^:.* MODE (.*) \+([A-Za-z]) (.*)$').search(line)
-		if matchModeset:
-			channel = matchModeset.group(1)
-			mode = matchModeset.group(2)
-			nick = matchModeset.group(3)
-			self._userModeSet.emit(channel, nick, mode)
-			return "continue"
-	
-	def _modeunset(self, line):
-		matchModeunset = re.compile('^:.* MODE (.*) -([A-Za-z]) (.*)$').search(line)
-		if matchModeunset:
-			channel = matchModeunset.group(1)
-			mode = matchModeunset.group(2)
-			nick = matchModeunset.group(3)
-			self._userModeUnset.emit(channel, nick, mode)
-			return "continue"
+			for line in lines:
+				if self._verbose:
+					_logRecv(line)
+				
+				self._handleLine(line)
 
 class Bot(object):
-	def __init__(self, nickname, password=''):
+	def __init__(self, nickname, password='', handlerWorkers=8, handlerQueueSize=1000, handlerSaturation='drop', handlerOrdered=False, handlerPool=None):
 		"""
 		Creates bot with nick as nickname
 		
 		Arguments:
 		- nickname: Nickname of the bot
+		- password: Password to send to NickServ
+		- handlerWorkers: Number of worker threads that run handlers registered with thread=True
+		- handlerQueueSize: Maximum number of handler calls waiting for a worker. 0 means unlimited.
+		- handlerSaturation: What to do when the queue is full: 'drop' the call (logged as a warning), run it on the 'caller' (the receive thread), or 'block' the receive thread until there is room. While the receive thread is blocked, the bot answers no PINGs, so 'block' is only safe when handlers can't hang.
+		- handlerOrdered: If True, handlers for the same channel run one after the other, in the order the lines arrived
+		- handlerPool: Existing handler pool to share with other bots. Overrides the other handler arguments.
 		"""
 		self._nick = nickname
 		self._pass = password
+		self._channelKeys = dict()
+		
+		# A pool passed in is kept even when the bot connects through a SelectorLoop
+		self._sharedPool = handlerPool is not None
+		if handlerPool is None:
+			handlerPool = _HandlerPool(handlerWorkers, handlerQueueSize, handlerSaturation, handlerOrdered)
+		self._handlerPool = handlerPool
+		self._selectorLoop = None
 		
 		self._connected = False
 		self._connecting = False
+		self._closing = False
 		
 		self._disconnectEvent = threading.Event()
 		
+		# Reconnects run on one supervisor thread, started the first time the connection dies
+		self._reconnectEvent = threading.Event()
+		self._supervisor = None
+		self._supervisorLock = threading.Lock()
+		self._diedAt = None
+		self._connectStats = {'attempts': 0, 'connectSeconds': 0.0, 'reconnects': 0, 'downtimeSeconds': None}
+		
 		self._msgResponseFunctions = []
 		self._joinResponseFunctions = []
 		self._partResponseFunctions = []
+		self._namesResponseFunctions = []
+		self._modeResponseFunctions = []
 		self._responseFunctionsLock = threading.Lock()
+		
+		self._modeBatcher = _ModeBatcher(lambda line: self._s._send(line, PRIORITY_MODERATION))
+		
+		# Channel state is changed under this lock. Readers that iterate get a snapshot, made under the lock and reused until the channel changes.
+		self._channels = dict()
+		self._snapshots = dict()
+		self._channelsLock = threading.Lock()
+		# Defaults until the server tells otherwise, so lines can be handled before the first connect
+		self._resetState([])
 	
-	def connect(self, host, port=6667, verbose=True, sleepTime=0.8, maxItems=10, channels=[]):
+	def connect(self, host, port=6667, verbose=True, sleepTime=0.8, maxItems=10, channels=[], burst=4, registerTimeout=30, loop=None):
 		"""
 		Connects the bot to a server. Every bot can connect to only one server.
-		If you want your bot to be on multiple servers, create multiple Bot objects.
+		If you want your bot to be on multiple servers, create multiple Bot objects. They can share one SelectorLoop.
 		
 		Arguments:
 		- host: Hostname of the server
 		- port: Port the server listens to
-		- verbose: If True, prints all the received and sent data
-		- sleepTime: Minimum time in seconds between two sent messages (used for flood control)
+		- verbose: If True, logs all the received and sent data, and notes about the connection. Starts logging to standard output with startLogging if nothing else was set up to handle the log.
+		- sleepTime: Time in seconds between two sent messages once the burst is used up (used for flood control). 0 disables flood control.
 		- maxItems: Maximum items in the queue. Queue is emptied after this amount is reached. 0 means unlimited. (used for flood control)
 		- channels: Channels to immediately join
+		- burst: Number of messages that may be sent back to back after the queue has been idle (used for flood control)
+		- registerTimeout: Maximum seconds to wait for the server to finish registration (end of MOTD), and then for NickServ to confirm the password, before going on
+		- loop: SelectorLoop to run the connection on. Without one, the bot uses a sender and a receive thread of its own.
+		
+		Returns once the server has accepted the connection and the channels have been joined.
 		"""
-		if self._connected:
-			if self._verbose:
-				print("NOTE:\tAlready connected. Can't connect twice.")
-		elif self._connecting:
-			if self._verbose:
-				print("NOTE:\tAlready trying to connect.")
+		if not self._beginConnect(host, port, verbose, sleepTime, maxItems, channels, burst, registerTimeout):
+			return
+		
+		self._selectorLoop = loop
+		if self._selectorLoop is not None and not self._sharedPool:
+			self._handlerPool = self._selectorLoop._handlerPool
+		
+		if self._selectorLoop is None:
+			self._s = _SuperSocket(self._sleepTime, self._maxItems, self._verbose, self._burst)
 		else:
-			self._connecting = True
-			
-			self._verbose = verbose
-			self._host = host
-			self._port = port
-			self._sleepTime = sleepTime
-			self._maxItems = maxItems
-			self._modes = dict()
-			
-			self._channels = dict()
-			for channel in channels:
-				self._channels[channel.upper()] = dict()
-			
-			self._s = _SuperSocket(self._sleepTime, self._maxItems, self._verbose)
-			self._s._shutdownEvent.connect(self.reconnect)
-			self._s._connect(self._host, self._port)
-			self._connected = True
-			
-			self.rename(self._nick)
-			self._s._send("USER {} {} {} :{}".format(self._nick, self._nick, self._nick, self._nick))
-			
+			self._s = _LoopSocket(self._selectorLoop, self._sleepTime, self._maxItems, self._verbose, self._burst)
+		self._s._shutdownEvent.connect(self._socketDied)
+		startTime = time.monotonic()
+		attempt = 0
+		while not self._s._connect(self._host, self._port):
+			attempt += 1
+			time.sleep(self._retryDelay(attempt))
+		self._register(startTime, attempt + 1)
+		
+		if self._selectorLoop is None:
 			# Run the main loop in another thread
-			self._receiveThread = _BotReceiveThread(self, self._verbose)
-			self._receiveThread.daemon = True
-			self._receiveThread._joinedEvent.connect(self._joinedChannel)
-			self._receiveThread._partedEvent.connect(self._partedChannel)
-			self._receiveThread._updateNames.connect(self._updateNames)
-			self._receiveThread._updateTopic.connect(self._updateTopic)
-			self._receiveThread._userModeSet.connect(self._userModeSet)
-			self._receiveThread._userModeUnset.connect(self._userModeUnset)
-			self._receiveThread.start()
-			
-			#Pause then verify Nick
-			time.sleep(5)
+			self._receiver = _BotReceiveThread(self, self._verbose)
+			self._receiver.daemon = True
+			self._connectReceiver(self._receiver)
+			self._receiver.start()
+		else:
+			self._receiver = _BotReceiver(self, self._verbose)
+			self._connectReceiver(self._receiver)
+			self._s._start(self._receiver)
+		
+		# Wait until the server is ready, then verify Nick
+		self._registrationWaited('ready', self._registration['ready'].wait(self._registerTimeout))
+		if self._pass:
 			self.verifyNick(self._pass)
-			
-			# Join initial channels
-			for channel in channels:
-				self.joinChannel(channel)
-			
-			self._connecting = False
+			self._registrationWaited('identified', self._registration['identified'].wait(self._registerTimeout))
+		
+		self._finishConnect(channels)
 	
 	def disconnect(self, message=''):
 		"""
@@ -442,14 +1383,30 @@ class Bot(object):
 		Arguments:
 		- message: Message to show when quitting.
 		"""
-		self._s._send("QUIT :{}".format(message))
+		self._closing = True
+		self._s._send("QUIT :{}".format(message), PRIORITY_PROTOCOL)
 		# Wait for the thread to be finished
-		self._receiveThread._shutdownEvent.wait(5)
-		self._s._quit = True
+		self._receiver._shutdownEvent.wait(5)
+		self._s._close()
 		self._connected = False
+		self._closing = False
+		self._stopSupervisor()
 		# Fire disconnected event
 		self._disconnectEvent.set()
 	
+	def _stopSupervisor(self):
+		# After a deliberate disconnect nothing is left to reconnect, so the supervisor thread is told to finish
+		with self._supervisorLock:
+			supervisor = self._supervisor
+			reconnectEvent = self._reconnectEvent
+			self._supervisor = None
+			self._reconnectEvent = threading.Event()
+		if supervisor is None:
+			return
+		reconnectEvent.set()
+		if supervisor is not threading.current_thread():
+			supervisor.join(5)
+	
 	def reconnect(self, message='', rejoin=True):
 		"""
 		Reconnects the bot to the server. Note that this does not reconnect to channels.
@@ -458,32 +1415,35 @@ class Bot(object):
 		- message: Message to show when quitting.
 		- rejoin: Rejoin channels
 		"""
-		self._s._send("QUIT :{}".format(message))
+		self._closing = True
+		self._s._send("QUIT :{}".format(message), PRIORITY_PROTOCOL)
 		# Wait for the thread to be finished
-		self._receiveThread._shutdownEvent.wait(5)
-		self._s._quit = True
+		self._receiver._shutdownEvent.wait(5)
+		self._s._close()
 		self._connected = False
-		# Connect again
-		if rejoin:
-			chanlist = list(self._channels.keys())
-			self.connect(self._host, self._port, self._verbose, self._sleepTime, self._maxItems)
-			for channel in chanlist:
-				self.joinChannel(channel)
-			
-		else:
-			self.connect(self._host, self._port, self._verbose, self._sleepTime, self._maxItems)
+		self._closing = False
+		# Connect again, rejoining all channels in as few JOIN lines as possible
+		chanlist = list(self._channels.keys()) if rejoin else []
+		self.connect(self._host, self._port, self._verbose, self._sleepTime, self._maxItems, chanlist, burst=self._burst, registerTimeout=self._registerTimeout, loop=self._selectorLoop)
+	
+	def getConnectStats(self):
+		"""
+		Returns a dictionary describing the last (re)connect:
+		- attempts: Connection attempts it took
+		- connectSeconds: Seconds from the first attempt until the connection was up
+		- reconnects: Number of automatic reconnects since the bot was created
+		- downtimeSeconds: Seconds from noticing the dead connection until it was up again, None if it never died
+		"""
+		return dict(self._connectStats)
 	
 	def getModes(self, channel):
 		"""
-		Returns the current modes of the bot in the channel.
+		Returns the current modes of the bot in the channel, as a frozenset.
 		
 		Arguments:
 		- channel: channel you want the modes of
 		"""
-		if channel.upper() in self._modes:
-			return self._modes[channel.upper()]
-		else:
-			return set()
+		return self._modes.get(channel.upper(), frozenset())
 	
 	"""
 	IRC commands
@@ -505,24 +1465,68 @@ class Bot(object):
 		Arguments:
 		- nickname: New nickname of the bot
 		"""
-		self._s._send("NICK {}".format(nickname))
+		self._s._send("NICK {}".format(nickname), PRIORITY_PROTOCOL)
 		self._nick = nickname
 	
-	def joinChannel(self, channel):
+	def joinChannel(self, channel, key=''):
 		"""
 		Joins a channel.
 		
 		Arguments:
 		- channel: Channel name
+		- key: Channel key (password), if the channel has one
+		"""
+		self.joinChannels([channel], {channel: key} if key else None)
+	
+	def joinChannels(self, channels, keys=None):
+		"""
+		Joins several channels using as few JOIN lines as the server allows.
+		Duplicate channels are joined once. Keys are remembered and used again when rejoining after a reconnect.
+		
+		Arguments:
+		- channels: List of channel names
+		- keys: Dictionary of channel name to channel key, for channels that have one
 		"""
-		self._s._send("JOIN {}".format(channel))
-		self._channels[channel.upper()] = dict()
+		if keys:
+			for channel, key in keys.items():
+				self._channelKeys[channel.upper()] = key
+		
+		keyed = []
+		unkeyed = []
+		seen = set()
+		for channel in channels:
+			channel = channel.strip()
+			if not channel or channel.upper() in seen:
+				continue
+			seen.add(channel.upper())
+			with self._channelsLock:
+				if channel.upper() not in self._channels:
+					self._channels[channel.upper()] = _Channel()
+			key = self._channelKeys.get(channel.upper())
+			if key:
+				keyed.append((channel, key))
+			else:
+				unkeyed.append((channel, ''))
+		
+		# Keys apply to the first channels of a JOIN line, so keyed channels go first
+		for line in _joinLines(keyed + unkeyed, self._targetLimit('JOIN')):
+			self._s._send(line)
 	
-	def _joinedChannel(self, nick, channel):
+	def _joinedChannel(self, nick, channel, client=''):
 		if nick == self._nick:
-			self._channels[channel.upper()] = dict()
+			# The server shows our own full source on our JOIN, which tells us how long our prefix is
+			self._prefix = "{}!{}".format(nick, client)
+			with self._channelsLock:
+				self._channels[channel.upper()] = _Channel()
+				self._snapshots.pop(channel.upper(), None)
 		else:
-			self._channels[channel.upper()]['names'].add(nick)
+			key = self._foldNick(nick)
+			with self._channelsLock:
+				chan = self._channels.get(channel.upper())
+				if chan is not None:
+					chan.members[key] = 0
+					chan.nicks[key] = nick
+					self._snapshots.pop(channel.upper(), None)
 	
 	def partChannel(self, channel):
 		"""
@@ -535,9 +1539,52 @@ class Bot(object):
 	
 	def _partedChannel(self, nick, channel):
 		if nick == self._nick:
-			del self._channels[channel.upper()]
+			with self._channelsLock:
+				self._channels.pop(channel.upper(), None)
+				self._snapshots.pop(channel.upper(), None)
+			self._modes.pop(channel.upper(), None)
 		else:
-			self._channels[channel.upper()]['names'].remove(nick)
+			key = self._foldNick(nick)
+			with self._channelsLock:
+				chan = self._channels.get(channel.upper())
+				if chan is not None and key in chan.members:
+					del chan.members[key]
+					chan.nicks.pop(key, None)
+					self._snapshots.pop(channel.upper(), None)
+	
+	def _userQuit(self, nick):
+		key = self._foldNick(nick)
+		with self._channelsLock:
+			for name, chan in self._channels.items():
+				if key in chan.members:
+					del chan.members[key]
+					chan.nicks.pop(key, None)
+					self._snapshots.pop(name, None)
+	
+	def _nickChanged(self, old, new):
+		oldKey = self._foldNick(old)
+		newKey = self._foldNick(new)
+		if oldKey == self._foldNick(self._nick):
+			self._nick = new
+		with self._channelsLock:
+			for name, chan in self._channels.items():
+				if oldKey in chan.members:
+					chan.members[newKey] = chan.members.pop(oldKey)
+					chan.nicks.pop(oldKey, None)
+					chan.nicks[newKey] = new
+					self._snapshots.pop(name, None)
+	
+	def _channelSnapshot(self, channel):
+		# Returns a copy of the channel that is never changed, or None if the channel is not joined
+		snapshot = self._snapshots.get(channel.upper())
+		if snapshot is None:
+			with self._channelsLock:
+				chan = self._channels.get(channel.upper())
+				if chan is None:
+					return None
+				snapshot = chan._copy()
+				self._snapshots[channel.upper()] = snapshot
+		return snapshot
 	
 	def setAway(self, message=''):
 		"""
@@ -563,7 +1610,9 @@ class Bot(object):
 		- client: Client to be kicked.
 		- message: Message to kick user with.
 		"""
-		self._s._send("KICK {} {} :{}".format(channel, client, message))
+		# Pending bans go out first, so the client cannot rejoin in between
+		self._modeBatcher.flush()
+		self._s._send("KICK {} {} :{}".format(channel, client, message), PRIORITY_MODERATION)
 		
 	def banUser(self, channel, client):
 		"""
@@ -575,27 +1624,37 @@ class Bot(object):
 		"""
 		clientname = client.split('@')
 		hostmask = "*!*@" + clientname[1]
-		self._s._send("MODE {} +b {}".format(channel, hostmask))
+		self._modeBatcher.add(channel, '+', 'b', hostmask)
 	
 	def setMode(self, channel, target, flag):
 		"""
 		Sets a user/channel flag.
+		Single flags with a target are sent together with other pending changes for the channel in one MODE line.
 		
 		Arguments:
 		- target: Channel or nickname of user to set the flag of
 		- flag: Flag (and optional arguments) to set
 		"""
-		self._s._send("MODE {} +{} {}".format(channel, flag, target))
+		if len(flag) == 1 and target:
+			self._modeBatcher.add(channel, '+', flag, target)
+		else:
+			self._modeBatcher.flush()
+			self._s._send("MODE {} +{} {}".format(channel, flag, target), PRIORITY_MODERATION)
 	
 	def unsetMode(self, channel, target, flag):
 		"""
 		Unsets a user/channel flag.
+		Single flags with a target are sent together with other pending changes for the channel in one MODE line.
 		
 		Arguments:
 		- target: Channel or nickname of user to set the flag of
 		- flag: Flag (and optional arguments) to set
 		"""
-		self._s._send("MODE {} -{} {}".format(channel, flag, target))
+		if len(flag) == 1 and target:
+			self._modeBatcher.add(channel, '-', flag, target)
+		else:
+			self._modeBatcher.flush()
+			self._s._send("MODE {} -{} {}".format(channel, flag, target), PRIORITY_MODERATION)
 	
 	def inviteUser(self, nickname, channel):
 		"""
@@ -607,25 +1666,112 @@ class Bot(object):
 		"""
 		self._s._send("INVITE {} {}".format(nickname, channel))
 	
-	def sendMsg(self, target, message):
+	def sendMsg(self, target, message, priority=PRIORITY_NORMAL):
 		"""
 		Send a message to a channel or user.
+		Messages too long for one line are split on UTF-8 character boundaries, at a space where possible.
 		
 		Arguments:
 		- target: Nickname or channel name to send message to.
 		- message: Message to send.
+		- priority: Send priority, PRIORITY_NORMAL by default. Use PRIORITY_BULK for long output that may wait.
 		"""
-		self._s._send("PRIVMSG {} :{}".format(target, message))
+		self._sendText("PRIVMSG", target, message, priority)
 	
-	def sendNotice(self, target, message):
+	def sendNotice(self, target, message, priority=PRIORITY_NORMAL):
 		"""
 		Send a notice to a channel or user.
+		Notices too long for one line are split like in sendMsg().
 		
 		Arguments:
 		- target: Nickname or channel name to send notice to.
 		- message: Message to send.
+		- priority: Send priority, PRIORITY_NORMAL by default. Use PRIORITY_BULK for long output that may wait.
+		"""
+		self._sendText("NOTICE", target, message, priority)
+	
+	def sendList(self, target, items, prefix='', separator=', ', maxLines=3, priority=PRIORITY_NORMAL, notice=False):
+		"""
+		Send a list of items to a channel or user, packed into as few lines as possible.
+		At most maxLines lines are sent. The rest is kept and can be sent with sendMore().
+		Returns the number of lines still waiting.
+		
+		Arguments:
+		- target: Nickname or channel name to send the list to.
+		- items: Strings to send.
+		- prefix: Text to put in front of the first line.
+		- separator: Text between two items on the same line.
+		- maxLines: Maximum number of lines to send now. 0 means unlimited.
+		- priority: Send priority.
+		- notice: Send as notices instead of messages.
+		"""
+		command = "NOTICE" if notice else "PRIVMSG"
+		budget = self._lineBudget(command, target)
+		lines = []
+		line = prefix
+		# Nothing but the prefix on the current line yet
+		empty = True
+		for item in items:
+			item = str(item)
+			candidate = line + item if empty else line + separator + item
+			if empty or len(candidate.encode()) <= budget:
+				line = candidate
+			else:
+				lines.append(line)
+				line = item
+			empty = False
+		if line:
+			lines.append(line)
+		
+		pages = []
+		for line in lines:
+			pages.extend(_splitText(line, budget))
+		return self._sendPage(target, command, pages, maxLines, priority)
+	
+	def sendMore(self, target, maxLines=3):
+		"""
+		Send the next lines of a list previously cut off by sendList().
+		Returns the number of lines still waiting.
+		
+		Arguments:
+		- target: Nickname or channel name the list was sent to.
+		- maxLines: Maximum number of lines to send now. 0 means unlimited.
+		"""
+		try:
+			command, pages, priority = self._more.pop(target.lower())
+		except KeyError:
+			return 0
+		return self._sendPage(target, command, pages, maxLines, priority)
+	
+	def hasMore(self, target):
+		"""
+		Returns the number of lines of a cut off list still waiting for target.
+		
+		Arguments:
+		- target: Nickname or channel name the list was sent to.
+		"""
+		try:
+			return len(self._more[target.lower()][1])
+		except KeyError:
+			return 0
+	
+	def requestNames(self, channel):
+		"""
+		Asks the server for the members of a channel again. The member list is replaced once the whole reply has arrived.
+		
+		Arguments:
+		- channel: Channel name.
+		"""
+		self._s._send("NAMES {}".format(channel))
+	
+	def requestWho(self, channel):
+		"""
+		Asks the server for a WHO listing of a channel. The member list is replaced once the whole reply has arrived.
+		
+		Arguments:
+		- channel: Channel name.
 		"""
-		self._s._send("NOTICE {} :{}".format(target, message))
+		self._s._send("WHO {}".format(channel))
 	
 	def setChannelTopic(self, channel, topic):
 		"""
@@ -644,53 +1790,139 @@ class Bot(object):
 		Arguments:
 		- channel: Channel name.
 		"""
-		try:
-			return self._channels[channel.upper()]['names']
-		except KeyError:
+		chan = self._channelSnapshot(channel)
+		if chan is None:
+			if self._verbose:
+				_log.info("Names of unjoined/unexisting channel requested.")
+			return None
+		return set(chan.nicks.values())
+	
+	def getNamesWithMode(self, channel, mode, orHigher=False):
+		"""
+		Gets the nicknames of all users in a channel that have a prefix mode.
+		
+		Arguments:
+		- channel: Channel name.
+		- mode: Prefix mode letter, like 'o' or 'v'.
+		- orHigher: If True, users with a higher ranked prefix mode are included too. A mode the server does not have counts as the next higher mode it does have.
+		"""
+		chan = self._channelSnapshot(channel)
+		if chan is None:
+			if self._verbose:
+				_log.info("Names of unjoined/unexisting channel requested.")
+			return set()
+		mask = self._modeMask(mode, orHigher)
+		return set(chan.nicks[key] for key, modes in chan.members.items() if modes & mask)
+	
+	def getMembers(self, channel):
+		"""
+		Gets all users in a channel with their prefix modes, all read from the same moment.
+		Returns a dictionary of nickname to a string of prefix mode letters, highest rank first, like 'ov' or ''.
+		
+		Arguments:
+		- channel: Channel name.
+		"""
+		chan = self._channelSnapshot(channel)
+		if chan is None:
 			if self._verbose:
-				print("NOTE:\tNames of unjoined/unexisting channel requested.")
+				_log.info("Names of unjoined/unexisting channel requested.")
+			return dict()
+		prefixModes = self._prefixModes
+		return dict((chan.nicks[key], ''.join(mode for index, mode in enumerate(prefixModes) if modes & (1 << index))) for key, modes in chan.members.items())
+	
+	def hasMode(self, channel, nick, mode, orHigher=False):
+		"""
+		Returns True if a user in a channel has a prefix mode.
+		
+		Arguments:
+		- channel: Channel name.
+		- nick: Nickname of the user.
+		- mode: Prefix mode letter, like 'o' or 'v'.
+		- orHigher: If True, a higher ranked prefix mode counts too. A mode the server does not have counts as the next higher mode it does have.
+		"""
+		# A single lookup needs no snapshot
+		chan = self._channels.get(channel.upper())
+		if chan is None:
+			return False
+		return bool(chan.members.get(self._foldNick(nick), 0) & self._modeMask(mode, orHigher))
+	
+	def _foldNick(self, nick):
+		return nick.translate(self._casemap)
+	
+	def _modeMask(self, mode, orHigher=False):
+		index = self._prefixModes.find(mode)
+		if index < 0:
+			if not orHigher or mode not in _COMMON_PREFIX:
+				return 0
+			# Fall back to the lowest ranked mode above it that the server has
+			for higher in reversed(_COMMON_PREFIX[:_COMMON_PREFIX.index(mode)]):
+				index = self._prefixModes.find(higher)
+				if index >= 0:
+					break
+			else:
+				return 0
+		if orHigher:
+			return (2 << index) - 1
+		return 1 << index
+	
+	def _updateNames(self, channel, names):
+		# Replies come in several lines, they are collected here until the end of the list
+		if channel.upper() not in self._channels:
+			return
+		if channel.upper() not in self._namesStaging:
+			self._namesStaging[channel.upper()] = _Channel()
+		staged = self._namesStaging[channel.upper()]
+		members = staged.members
+		nicks = staged.nicks
+		symbols = self._prefixSymbols
+		for name in names:
+			# With multi-prefix a user can show several symbols, like @+nick
+			modes = 0
+			start = 0
+			while start < len(name) and name[start] in symbols:
+				modes |= 1 << symbols.index(name[start])
+				start += 1
+			# With userhost-in-names the name is a full nick!user@host
+			nick = name[start:].partition('!')[0]
+			key = self._foldNick(nick)
+			members[key] = modes
+			nicks[key] = nick
 	
-	def _updateNames(self, channel, namesSet, opsSet, voicesSet, ownerSet, aopsSet, hopsSet):
-		self._channels[channel.upper()]['names'] = namesSet
-		self._channels[channel.upper()]['ops'] = opsSet
-		self._channels[channel.upper()]['voices'] = voicesSet
-		self._channels[channel.upper()]['owner'] = ownerSet
-		self._channels[channel.upper()]['aops'] = aopsSet
-		self._channels[channel.upper()]['hops'] = hopsSet		
+	def _namesEnd(self, channel):
+		staged = self._namesStaging.pop(channel.upper(), None)
+		chan = self._channels.get(channel.upper())
+		if staged is None or chan is None:
+			return
+		# Swapping in the whole channel means readers never see a half-filled list
+		with self._channelsLock:
+			staged.topic = chan.topic
+			self._channels[channel.upper()] = staged
+			self._snapshots.pop(channel.upper(), None)
 	
 	def _userModeSet(self, channel, nick, mode):
-		if mode == 'o':
-			self._channels[channel.upper()]['ops'].add(nick)
-		elif mode == 'h':
-			self._channels[channel.upper()]['hops'].add(nick)			
-		elif mode == 'a':
-			self._channels[channel.upper()]['aops'].add(nick)
-		elif mode == 'qo':
-			self._channels[channel.upper()]['owner'].add(nick)
-		elif mode == 'v':
-			self._channels[channel.upper()]['voices'].add(nick)
+		index = self._prefixModes.find(mode)
+		if index >= 0:
+			key = self._foldNick(nick)
+			with self._channelsLock:
+				chan = self._channels.get(channel.upper())
+				if chan is not None and key in chan.members:
+					chan.members[key] |= 1 << index
+					self._snapshots.pop(channel.upper(), None)
 		if nick == self._nick:
-			if not channel.upper() in self._modes:
-				self._modes[channel.upper()] = set()
-			self._modes[channel.upper()].add(mode)
+			self._modes[channel.upper()] = self._modes.get(channel.upper(), frozenset()) | set(mode)
 	
 	def _userModeUnset(self, channel, nick, mode):
-		try:
-			if mode == 'o':
-				self._channels[channel.upper()]['ops'].remove(nick)
-			elif mode == 'h':
-				self._channels[channel.upper()]['hops'].remove(nick)			
-			elif mode == 'a':
-				self._channels[channel.upper()]['aops'].remove(nick)
-			elif mode == 'qo':
-				self._channels[channel.upper()]['owner'].remove(nick)
-			elif mode == 'v':
-				self._channels[channel.upper()]['voices'].remove(nick)
-			if nick == self._nick:
-				self._modes[channel.upper()].remove(mode)
-		except:
-			print('*** Mode Unset Key Error ***')
-
+		index = self._prefixModes.find(mode)
+		if index >= 0:
+			key = self._foldNick(nick)
+			with self._channelsLock:
+				chan = self._channels.get(channel.upper())
+				if chan is not None and key in chan.members:
+					chan.members[key] &= ~(1 << index)
+					self._snapshots.pop(channel.upper(), None)
+		if nick == self._nick and channel.upper() in self._modes:
+			self._modes[channel.upper()] = self._modes[channel.upper()] - set(mode)
+	
 	def getOps(self, channel):
 		"""
 		Gets the nicknames of all the ops in a channel.
@@ -698,13 +1930,8 @@ class Bot(object):
 		Arguments:
 		- channel: Channel name.
 		"""
-		
-		try:
-			return self._channels[channel.upper()]['ops']
-		except KeyError:
-			if self._verbose:
-				print("NOTE:\tOps of unjoined/unexisting channel requested.")
-				
+		return self.getNamesWithMode(channel, 'o')
+	
 	def getOwner(self, channel):
 		"""
 		Gets the nicknames of all the Owners in a channel.
@@ -712,13 +1939,8 @@ class Bot(object):
 		Arguments:
 		- channel: Channel name.
 		"""
-		
-		try:
-			return self._channels[channel.upper()]['owner']
-		except KeyError:
-			if self._verbose:
-				print("NOTE:\tOwner of unjoined/unexisting channel requested.")
-				
+		return self.getNamesWithMode(channel, 'q')
+	
 	def getAops(self, channel):
 		"""
 		Gets the nicknames of all the aops in a channel.
@@ -726,12 +1948,7 @@ class Bot(object):
 		Arguments:
 		- channel: Channel name.
 		"""
-		
-		try:
-			return self._channels[channel.upper()]['aops']
-		except KeyError:
-			if self._verbose:
-				print("NOTE:\taops of unjoined/unexisting channel requested.")
+		return self.getNamesWithMode(channel, 'a')
 	
 	def getHops(self, channel):
 		"""
@@ -740,12 +1957,7 @@ class Bot(object):
 		Arguments:
 		- channel: Channel name.
 		"""
-		
-		try:
-			return self._channels[channel.upper()]['hops']
-		except KeyError:
-			if self._verbose:
-				print("NOTE:\thops of unjoined/unexisting channel requested.")
+		return self.getNamesWithMode(channel, 'h')
 	
 	def getVoices(self, channel):
 		"""
@@ -754,12 +1966,7 @@ class Bot(object):
 		Arguments:
 		- channel: Channel name.
 		"""
-		
-		try:
-			return self._channels[channel.upper()]['voices']
-		except KeyError:
-			if self._verbose:
-				print("NOTE:\tVoices of unjoined/unexisting channel requested.")
+		return self.getNamesWithMode(channel, 'v')
 	
 	def getTopic(self, channel):
 		"""
@@ -769,15 +1976,54 @@ class Bot(object):
 		- channel: Channel name.
 		"""
 		try:
-			return self._channels[channel.upper()]['topic']
+			return self._channels[channel.upper()].topic
 		except KeyError:
 			if self._verbose:
-				print("NOTE:\tTopic of unjoined/unexisting channel requested.")
+				_log.info("Topic of unjoined/unexisting channel requested.")
+	
+	def _registrationStep(self, step):
+		self._registration[step].set()
+		if step == 'ready':
+			# A server that skips the MOTD still counts as ready
+			self._registration['welcome'].set()
+	
+	def _updateISupport(self, tokens):
+		for token in tokens:
+			if token[:1] == '-':
+				self._isupport.pop(token[1:].upper(), None)
+				continue
+			key, _, value = token.partition('=')
+			self._isupport[key.upper()] = value
+		if 'PREFIX' in self._isupport:
+			# PREFIX=(ov)@+ lists the modes and their symbols from the highest rank down
+			modes, _, symbols = self._isupport['PREFIX'][1:].partition(')')
+			if len(modes) == len(symbols):
+				self._prefixModes = modes
+				self._prefixSymbols = symbols
+		if 'CHANMODES' in self._isupport:
+			# CHANMODES=A,B,C,D: list modes and modes that always take an argument, modes that take one only when set, modes that take none
+			groups = self._isupport['CHANMODES'].split(',') + ['', '', '']
+			self._paramModes = groups[0] + groups[1] + self._prefixModes
+			self._paramModesSet = groups[2]
+		else:
+			self._paramModes = _PARAM_MODES + self._prefixModes
+			self._paramModesSet = _PARAM_MODES_SET
+		self._casemap = _CASEMAPS.get(self._isupport.get('CASEMAPPING', 'rfc1459').lower(), _CASEMAPS['rfc1459'])
+		if 'MODES' in self._isupport:
+			try:
+				self._modeBatcher._maxModes = int(self._isupport['MODES'])
+			except ValueError:
+				# MODES without a value means no limit, line length still applies
+				self._modeBatcher._maxModes = _UNLIMITED_MODES
 	
 	def _updateTopic(self, channel, topic):
-		self._channels[channel.upper()]['topic'] = topic
+		with self._channelsLock:
+			chan = self._channels.get(channel.upper())
+			if chan is not None:
+				chan.topic = topic
+				self._snapshots.pop(channel.upper(), None)
 	
-	def addMsgHandler(self, function, message=".*", channel='.*', nickname='.*', client='.*', messageFlags=0, channelFlags=0, nicknameFlags=0, clientFlags=0, thread=True):
+	def addMsgHandler(self, function, message=".*", channel='.*', nickname='.*', client='.*', messageFlags=0, channelFlags=0, nicknameFlags=0, clientFlags=0, thread=True, passMessage=False):
 		"""
 		Adds a function to the list of functions that should be executed on every received message.
 		Please keep in mind that the functions are all executed concurrently.
@@ -793,23 +2039,30 @@ class Bot(object):
 		- channelFlags: Flags for the channel regex, as documented here: http://docs.python.org/library/re.html#re.compile
 		- nicknameFlags: Flags for the nickname regex, as documented here: http://docs.python.org/library/re.html#re.compile
 		- clientFlags: Flags for the client regex, as documented here: http://docs.python.org/library/re.html#re.compile
-		- thread: Execute function in seperate thread
+		- thread: Execute function on the handler pool instead of the receive thread
+		- passMessage: If True, the parsed Message object is passed as an extra last argument
 		
-		The function should have 5 arguments:
+		The function should have 5 arguments (6 with passMessage):
 		- message: The first argument will be the message that was received.
 		- channel: The second argument will be the channel the message was sent to. This will be the same as nickname when this was a private message.
 		- nickname: The third argument will be the nickname of the user who sent the message.
 		- client: The fourth argument will be the client of the user who sent this message.
 		- message match: Match object (http://docs.python.org/library/re.html#match-objects) of the regex applied to the message.
-		"""
+		- raw message: The Message object of the received line (only with passMessage).
+		"""
+		responseFunctionDict = {
+			'func': function,
+			'thread': thread,
+			'passMessage': passMessage,
+			'message': _compileFilter(message, messageFlags),
+			'channel': _compileFilter(channel, channelFlags),
+			'nickname': _compileFilter(nickname, nicknameFlags),
+			'client': _compileFilter(client, clientFlags)
+		}
 		with self._responseFunctionsLock:
-			responseFunction = lambda rmsg, rnick, rclient, rchannel: self._msgResponseFunction(function, rmsg, rnick, rclient, rchannel, message, channel, nickname, client, messageFlags, channelFlags, nicknameFlags, clientFlags)
-			responseFunctionDict = {
-				'func': responseFunction,
-				'thread': thread
-			}
-			self._msgResponseFunctions.append(responseFunctionDict)
-			return responseFunctionDict
+			# Copy on write, so the receive thread can iterate without taking the lock
+			self._msgResponseFunctions = self._msgResponseFunctions + [responseFunctionDict]
+		return responseFunctionDict
 	
 	def removeMsgHandler(self, responseFunction):
 		"""
@@ -819,10 +2072,12 @@ class Bot(object):
 		responseFunction: Function that is returned by addMsgHandler()
 		"""
 		with self._responseFunctionsLock:
-			self._msgResponseFunctions.remove(responseFunction)
+			functions = list(self._msgResponseFunctions)
+			functions.remove(responseFunction)
+			self._msgResponseFunctions = functions
 
 
-	def addJoinHandler(self, function, channel='.*', nickname='.*', client='.*', channelFlags=0, nicknameFlags=0, clientFlags=0, thread=True):
+	def addJoinHandler(self, function, channel='.*', nickname='.*', client='.*', channelFlags=0, nicknameFlags=0, clientFlags=0, thread=True, passMessage=False):
 		"""
 		Adds a function to the list of functions that should be executed on every received message.
 		Please keep in mind that the functions are all executed concurrently.
@@ -836,21 +2091,26 @@ class Bot(object):
 		- channelFlags: Flags for the channel regex, as documented here: http://docs.python.org/library/re.html#re.compile
 		- nicknameFlags: Flags for the nickname regex, as documented here: http://docs.python.org/library/re.html#re.compile
 		- clientFlags: Flags for the client regex, as documented here: http://docs.python.org/library/re.html#re.compile
-		- thread: Execute function in seperate thread
+		- thread: Execute function on the handler pool instead of the receive thread
+		- passMessage: If True, the parsed Message object is passed as an extra last argument
 		
-		The function should have 5 arguments:
+		The function should have 3 arguments (4 with passMessage):
 		- channel: The second argument will be the channel the message was sent to. This will be the same as nickname when this was a private message.
 		- nickname: The third argument will be the nickname of the user who sent the message.
 		- client: The fourth argument will be the client of the user who sent this message.
-		"""
+		- raw message: The Message object of the received line (only with passMessage).
+		"""
+		responseFunctionDict = {
+			'func': function,
+			'thread': thread,
+			'passMessage': passMessage,
+			'channel': _compileFilter(channel, channelFlags),
+			'nickname': _compileFilter(nickname, nicknameFlags),
+			'client': _compileFilter(client, clientFlags)
+		}
 		with self._responseFunctionsLock:
-			responseFunction = lambda rnick, rclient, rchannel: self._joinResponseFunction(function, rnick, rclient, rchannel, channel, nickname, client, channelFlags, nicknameFlags, clientFlags)
-			responseFunctionDict = {
-				'func': responseFunction,
-				'thread': thread
-			}
-			self._joinResponseFunctions.append(responseFunctionDict)
-			return responseFunctionDict
+			self._joinResponseFunctions = self._joinResponseFunctions + [responseFunctionDict]
+		return responseFunctionDict
 	
 	def removeJoinHandler(self, responseFunction):
 		"""
@@ -860,9 +2120,11 @@ class Bot(object):
 		responseFunction: Function that is returned by addJoinHandler()
 		"""
 		with self._responseFunctionsLock:
-			self._joinResponseFunctions.remove(responseFunction)
+			functions = list(self._joinResponseFunctions)
+			functions.remove(responseFunction)
+			self._joinResponseFunctions = functions
 
-	def addPartHandler(self, function, channel='.*', nickname='.*', client='.*', channelFlags=0, nicknameFlags=0, clientFlags=0, thread=True):
+	def addPartHandler(self, function, channel='.*', nickname='.*', client='.*', channelFlags=0, nicknameFlags=0, clientFlags=0, thread=True, passMessage=False):
 		"""
 		Adds a function to the list of functions that should be executed on every channel Part.
 		Please keep in mind that the functions are all executed concurrently.
@@ -876,21 +2138,26 @@ class Bot(object):
 		- channelFlags: Flags for the channel regex, as documented here: http://docs.python.org/library/re.html#re.compile
 		- nicknameFlags: Flags for the nickname regex, as documented here: http://docs.python.org/library/re.html#re.compile
 		- clientFlags: Flags for the client regex, as documented here: http://docs.python.org/library/re.html#re.compile
-		- thread: Execute function in seperate thread
+		- thread: Execute function on the handler pool instead of the receive thread
+		- passMessage: If True, the parsed Message object is passed as an extra last argument
 		
-		The function should have 5 arguments:
+		The function should have 3 arguments (4 with passMessage):
 		- channel: The second argument will be the channel the message was sent to. This will be the same as nickname when this was a private message.
 		- nickname: The third argument will be the nickname of the user who sent the message.
 		- client: The fourth argument will be the client of the user who sent this message.
-		"""
+		- raw message: The Message object of the received line (only with passMessage).
+		"""
+		responseFunctionDict = {
+			'func': function,
+			'thread': thread,
+			'passMessage': passMessage,
+			'channel': _compileFilter(channel, channelFlags),
+			'nickname': _compileFilter(nickname, nicknameFlags),
+			'client': _compileFilter(client, clientFlags)
+		}
 		with self._responseFunctionsLock:
-			responseFunction = lambda rnick, rclient, rchannel: self._partResponseFunction(function, rnick, rclient, rchannel, channel, nickname, client, channelFlags, nicknameFlags, clientFlags)
-			responseFunctionDict = {
-				'func': responseFunction,
-				'thread': thread
-			}
-			self._partResponseFunctions.append(responseFunctionDict)
-			return responseFunctionDict
+			self._partResponseFunctions = self._partResponseFunctions + [responseFunctionDict]
+		return responseFunctionDict
 	
 	def removePartHandler(self, responseFunction):
 		"""
@@ -900,7 +2167,96 @@ class Bot(object):
 		responseFunction: Function that is returned by addPartHandler()
 		"""
 		with self._responseFunctionsLock:
-			self._partResponseFunctions.remove(responseFunction)
+			functions = list(self._partResponseFunctions)
+			functions.remove(responseFunction)
+			self._partResponseFunctions = functions
+	
+	def addNamesHandler(self, function, channel='.*', channelFlags=0, thread=True, passMessage=False):
+		"""
+		Adds a function to the list of functions that should be executed when the member list of a channel is complete.
+		This is the end of a NAMES reply (sent by the server after the bot joins a channel, or asked for with requestNames()) or of a WHO reply (requestWho()).
+		By the time the function runs, getNames(), getMembers() and hasMode() already reflect the new list.
+		Returns a function that can be used to remove the handler again with removeNamesHandler().
+		
+		Arguments:
+		- function: The function that should be called
+		- channel: Regex that should match the channel. If it does not, the function will not be called.
+		- channelFlags: Flags for the channel regex, as documented here: http://docs.python.org/library/re.html#re.compile
+		- thread: Execute function on the handler pool instead of the receive thread
+		- passMessage: If True, the parsed Message object is passed as an extra last argument
+		
+		The function should have 1 argument (2 with passMessage):
+		- channel: The channel whose member list is complete.
+		- raw message: The Message object of the received line (only with passMessage).
+		"""
+		responseFunctionDict = {
+			'func': function,
+			'thread': thread,
+			'passMessage': passMessage,
+			'channel': _compileFilter(channel, channelFlags)
+		}
+		with self._responseFunctionsLock:
+			self._namesResponseFunctions = self._namesResponseFunctions + [responseFunctionDict]
+		return responseFunctionDict
+	
+	def removeNamesHandler(self, responseFunction):
+		"""
+		Remove a function from the list of functions that should be executed when a member list is complete.
+		
+		Arguments:
+		responseFunction: Function that is returned by addNamesHandler()
+		"""
+		with self._responseFunctionsLock:
+			functions = list(self._namesResponseFunctions)
+			functions.remove(responseFunction)
+			self._namesResponseFunctions = functions
+	
+	def addModeHandler(self, function, channel='.*', nickname='.*', mode='.*', channelFlags=0, nicknameFlags=0, thread=True, passMessage=False):
+		"""
+		Adds a function to the list of functions that should be executed on every mode change that applies to a user or takes an argument (+o nick, -v nick, +b mask...).
+		A MODE line with several changes calls the function once per change, after the bot's own channel state has been updated.
+		Returns a function that can be used to remove the handler again with removeModeHandler().
+		
+		Arguments:
+		- function: The function that should be called
+		- channel: Regex that should match the channel. If it does not, the function will not be called.
+		- nickname: Regex that should match the nickname (or other argument) the mode applies to. If it does not, the function will not be called.
+		- mode: Regex that should match the mode letter. If it does not, the function will not be called.
+		- channelFlags: Flags for the channel regex, as documented here: http://docs.python.org/library/re.html#re.compile
+		- nicknameFlags: Flags for the nickname regex, as documented here: http://docs.python.org/library/re.html#re.compile
+		- thread: Execute function on the handler pool instead of the receive thread
+		- passMessage: If True, the parsed Message object is passed as an extra last argument
+		
+		The function should have 4 arguments (5 with passMessage):
+		- channel: The first argument will be the channel the mode was changed in.
+		- nickname: The second argument will be the nickname (or other argument) the mode applies to.
+		- mode: The third argument will be the mode letter.
+		- sign: The fourth argument will be '+' if the mode was set and '-' if it was unset.
+		- raw message: The Message object of the received line (only with passMessage).
+		"""
+		responseFunctionDict = {
+			'func': function,
+			'thread': thread,
+			'passMessage': passMessage,
+			'channel': _compileFilter(channel, channelFlags),
+			'nickname': _compileFilter(nickname, nicknameFlags),
+			'mode': _compileFilter(mode, 0)
+		}
+		with self._responseFunctionsLock:
+			self._modeResponseFunctions = self._modeResponseFunctions + [responseFunctionDict]
+		return responseFunctionDict
+	
+	def removeModeHandler(self, responseFunction):
+		"""
+		Remove a function from the list of functions that should be executed on every mode change.
+		
+		Arguments:
+		responseFunction: Function that is returned by addModeHandler()
+		"""
+		with self._responseFunctionsLock:
+			functions = list(self._modeResponseFunctions)
+			functions.remove(responseFunction)
+			self._modeResponseFunctions = functions
 
 	def waitForDisconnect(self):
 		"""
@@ -912,47 +2268,474 @@ class Bot(object):
 	Internal functions
 	"""
 	
-	def _msgResponseFunction(self, function, msg, nick, client, channel, msgConstraint, channelsConstraint, nicksConstraint, clientsConstraint, msgFlags, channelFlags, nickFlags, clientFlags):
-		channelsMatch = re.compile(channelsConstraint, channelFlags).search(channel)
-		if not channelsMatch:
-			return
-		nicksMatch = re.compile(nicksConstraint, nickFlags).search(nick)
-		if not nicksMatch:
-			return
-		clientsMatch = re.compile(clientsConstraint, clientFlags).search(client)
-		if not clientsMatch:
-			return
-		msgMatch = re.compile(msgConstraint, msgFlags).search(msg)
-		if not msgMatch:
+	def _lineBudget(self, command, target):
+		# Bytes left for the text of a message after everything the server adds when relaying it
+		if self._prefix is not None:
+			prefix = self._prefix
+		else:
+			prefix = "{}!{}@{}".format(self._nick, 'x' * _MAX_USER, 'x' * _MAX_HOST)
+		return _MAX_LINE - len(":{} {} {} :".format(prefix, command, target).encode())
+	
+	def _sendText(self, command, target, message, priority):
+		budget = self._lineBudget(command, target)
+		for line in _splitText(message, budget):
+			self._s._send("{} {} :{}".format(command, target, line), priority)
+	
+	def _sendPage(self, target, command, pages, maxLines, priority):
+		if maxLines > 0 and len(pages) > maxLines:
+			self._more[target.lower()] = (command, pages[maxLines:], priority)
+			pages = pages[:maxLines]
+		else:
+			self._more.pop(target.lower(), None)
+		for line in pages:
+			self._s._send("{} {} :{}".format(command, target, line), priority)
+		return self.hasMore(target)
+	
+	def _targetLimit(self, command):
+		# Maximum targets per command from ISUPPORT TARGMAX (e.g. TARGMAX=JOIN:,PRIVMSG:4), 0 for no limit
+		for target in self._isupport.get('TARGMAX', '').split(','):
+			name, _, limit = target.partition(':')
+			if name.upper() == command:
+				return int(limit) if limit.isdigit() else 0
+		return 0
+	
+	def _socketDied(self):
+		# Called from the sender or receive thread, reconnecting is left to the supervisor
+		if self._connected and not self._connecting and not self._closing:
+			self._diedAt = time.monotonic()
+			with self._supervisorLock:
+				if self._supervisor is None:
+					self._supervisor = threading.Thread(target=self._supervise, args=(self._reconnectEvent,))
+					self._supervisor.daemon = True
+					self._supervisor.start()
+				self._reconnectEvent.set()
+	
+	def _supervise(self, reconnectEvent):
+		# Runs until disconnect() replaces the event this supervisor waits on
+		while True:
+			reconnectEvent.wait()
+			reconnectEvent.clear()
+			if reconnectEvent is not self._reconnectEvent:
+				return
+			self._connectStats['reconnects'] += 1
+			try:
+				self.reconnect()
+			except Exception:
+				_log.exception("Reconnect failed.")
+	
+	def _beginConnect(self, host, port, verbose, sleepTime, maxItems, channels, burst, registerTimeout):
+		# First part of connect(), shared with AsyncBot. Returns False if the bot is already connected or connecting.
+		if self._connected:
+			if self._verbose:
+				_log.info("Already connected. Can't connect twice.")
+			return False
+		if self._connecting:
+			if self._verbose:
+				_log.info("Already trying to connect.")
+			return False
+		self._connecting = True
+		
+		self._verbose = verbose
+		if self._verbose and not _log.hasHandlers():
+			startLogging(propagate=True)
+		self._host = host
+		self._port = port
+		self._sleepTime = sleepTime
+		self._burst = burst
+		self._maxItems = maxItems
+		self._registerTimeout = registerTimeout
+		self._resetState(channels)
+		return True
+	
+	def _retryDelay(self, attempt):
+		delay = _backoffDelay(attempt)
+		if self._verbose:
+			_log.info("Connection attempt %s failed. Retrying in %.1fs.", attempt, delay)
+		return delay
+	
+	def _register(self, startTime, attempts):
+		# The socket is connected, introduce the bot to the server
+		self._connected = True
+		self._recordConnect(startTime, attempts)
+		
+		self.rename(self._nick)
+		self._s._send("USER {} {} {} :{}".format(self._nick, self._nick, self._nick, self._nick), PRIORITY_PROTOCOL)
+	
+	def _registrationWaited(self, step, done):
+		if done or not self._verbose:
 			return
+		if step == 'ready':
+			_log.warning("No end of MOTD from the server, going on anyway.")
+		else:
+			_log.warning("NickServ did not confirm the password, going on anyway.")
+	
+	def _finishConnect(self, channels):
+		# Join initial channels
+		self.joinChannels(channels)
+		
+		self._connecting = False
+		
+		# The connection may have died while we were still setting it up
+		if self._s._quit:
+			self._socketDied()
+	
+	def _recordConnect(self, startTime, attempts):
+		now = time.monotonic()
+		self._connectStats['attempts'] = attempts
+		self._connectStats['connectSeconds'] = now - startTime
+		if self._diedAt is not None:
+			self._connectStats['downtimeSeconds'] = now - self._diedAt
+			self._diedAt = None
+		if self._verbose:
+			_log.info("Connected after %s attempt(s) in %.2fs.", attempts, self._connectStats['connectSeconds'])
+	
+	def _resetState(self, channels):
+		# Per-connection state, cleared on every (re)connect
+		self._modes = dict()
+		self._prefix = None
+		self._more = dict()
+		self._isupport = dict()
+		self._modeBatcher._maxModes = _DEFAULT_MODES
+		self._prefixModes, self._prefixSymbols = _DEFAULT_PREFIX
+		self._paramModes = _PARAM_MODES
+		self._paramModesSet = _PARAM_MODES_SET
+		self._namesStaging = dict()
+		self._casemap = _CASEMAPS['rfc1459']
+		self._registration = {'welcome': threading.Event(), 'ready': threading.Event(), 'identified': threading.Event()}
+		
+		with self._channelsLock:
+			self._channels = dict()
+			self._snapshots = dict()
+			for channel in channels:
+				self._channels[channel.upper()] = _Channel()
+	
+	def _connectReceiver(self, receiver):
+		receiver._joinedEvent.connect(self._joinedChannel)
+		receiver._partedEvent.connect(self._partedChannel)
+		receiver._quitEvent.connect(self._userQuit)
+		receiver._nickEvent.connect(self._nickChanged)
+		receiver._updateNames.connect(self._updateNames)
+		receiver._namesEnd.connect(self._namesEnd)
+		receiver._updateTopic.connect(self._updateTopic)
+		receiver._userModeSet.connect(self._userModeSet)
+		receiver._userModeUnset.connect(self._userModeUnset)
+		receiver._updateISupport.connect(self._updateISupport)
+		receiver._registrationStep.connect(self._registrationStep)
+	
+	def _runHandler(self, func, args, key=None):
+		if func['thread']:
+			# On a SelectorLoop this runs on the loop thread, which all bots on the loop need for their reads, writes and PONGs
+			self._handlerPool.submit(func['func'], args, key, self._selectorLoop is None)
+		else:
+			func['func'](*args)
+	
+	def _msgResponseFunction(self, func, msg, nick, client, channel, message):
+		# Returns the arguments to call the handler with, or None if one of its filters does not match
+		if func['channel'] is not None and not func['channel'].search(channel):
+			return None
+		if func['nickname'] is not None and not func['nickname'].search(nick):
+			return None
+		if func['client'] is not None and not func['client'].search(client):
+			return None
+		if func['message'] is None:
+			msgMatch = _MATCH_ALL_RE.match(msg)
+		else:
+			msgMatch = func['message'].search(msg)
+			if not msgMatch:
+				return None
 		
 		# If this was a private message, the channel is my own nick
 		if channel == self._nick:
 			# Set the channel to the other's nick
 			channel = nick
 		
-		function(msg, channel, nick, client, msgMatch)
+		if func['passMessage']:
+			return (msg, channel, nick, client, msgMatch, message)
+		return (msg, channel, nick, client, msgMatch)
+	
+	def _joinResponseFunction(self, func, nick, client, channel, message):
+		if func['channel'] is not None and not func['channel'].search(channel):
+			return None
+		if func['nickname'] is not None and not func['nickname'].search(nick):
+			return None
+		if func['client'] is not None and not func['client'].search(client):
+			return None
+		if func['passMessage']:
+			return (channel, nick, client, message)
+		return (channel, nick, client)
+	
+	# Part handlers take the same arguments and filters as join handlers
+	_partResponseFunction = _joinResponseFunction
+	
+	def _namesResponseFunction(self, func, channel, message):
+		if func['channel'] is not None and not func['channel'].search(channel):
+			return None
+		if func['passMessage']:
+			return (channel, message)
+		return (channel,)
+	
+	def _modeResponseFunction(self, func, channel, nick, mode, sign, message):
+		if func['channel'] is not None and not func['channel'].search(channel):
+			return None
+		if func['nickname'] is not None and not func['nickname'].search(nick):
+			return None
+		if func['mode'] is not None and not func['mode'].search(mode):
+			return None
+		if func['passMessage']:
+			return (channel, nick, mode, sign, message)
+		return (channel, nick, mode, sign)
 
-	def _joinResponseFunction(self, function, nick, client, channel, channelsConstraint, nicksConstraint, clientsConstraint, channelFlags, nickFlags, clientFlags):
-		channelsMatch = re.compile(channelsConstraint, channelFlags).search(channel)
-		if not channelsMatch:
-			return
-		nicksMatch = re.compile(nicksConstraint, nickFlags).search(nick)
-		if not nicksMatch:
-			return
-		clientsMatch = re.compile(clientsConstraint, clientFlags).search(client)
-		if not clientsMatch:
-			return
-		function(channel, nick, client)
+class _AsyncSuperSocket(_BaseSocket):
+	"""asyncio stream pair with flooding control"""
+	def __init__(self, loop, sleepTime, maxItems, verbose=True, burst=4, *args, **kwargs):
+		super(_AsyncSuperSocket, self).__init__(sleepTime, maxItems, verbose, burst, *args, **kwargs)
+		
+		self._loop = loop
+		self._queuedEvent = asyncio.Event()
+		self._reader = None
+		self._writer = None
+		self._senderTask = None
+	
+	async def _sender(self):
+		while not self._quit:
+			while not self._messageQueue:
+				self._queuedEvent.clear()
+				await self._queuedEvent.wait()
+			# Flood control. The line is picked after waiting, so a PONG queued meanwhile goes first.
+			wait = self._bucket.delay()
+			while wait > 0:
+				await asyncio.sleep(wait)
+				wait = self._bucket.delay()
+			data = self._messageQueue.get_nowait()
+			data = data + "\r\n"
+			try:
+				self._writer.write(data.encode())
+				await self._writer.drain()
+			except (OSError, RuntimeError):
+				self._die()
+				return
+			if self._verbose:
+				_logLine('SENT', data.rstrip())
+	
+	async def _connect(self, host, port, timeout=_CONNECT_TIMEOUT):
+		"""Tries every address the host resolves to once, on an executor thread. Returns True and starts the sender task on success."""
+		s = await self._loop.run_in_executor(None, self._openSocket, host, port, timeout)
+		if s is None:
+			return False
+		s.setblocking(False)
+		try:
+			self._reader, self._writer = await asyncio.open_connection(sock=s)
+		except OSError:
+			s.close()
+			return False
+		self._s = s
+		self._senderTask = self._loop.create_task(self._sender())
+		return True
+	
+	def _queued(self):
+		# May be called from handler threads as well as from the event loop
+		try:
+			running = asyncio.get_running_loop()
+		except RuntimeError:
+			running = None
+		if running is self._loop:
+			self._queuedEvent.set()
+		else:
+			self._loop.call_soon_threadsafe(self._queuedEvent.set)
+	
+	async def _recv(self):
+		"""Waits until data arrives and returns the complete lines received so far, or None if the connection died"""
+		try:
+			data = await self._reader.read(self._framer.readSize)
+		except OSError:
+			self._die()
+			return None
+		if not data:
+			self._die()
+			return None
+		return self._framer.feed(data)
+	
+	def _close(self):
+		self._quit = True
+		if self._senderTask is not None:
+			self._senderTask.cancel()
+		if self._writer is not None:
+			self._writer.close()
 
-	def _partResponseFunction(self, function, nick, client, channel, channelsConstraint, nicksConstraint, clientsConstraint, channelFlags, nickFlags, clientFlags):
-		channelsMatch = re.compile(channelsConstraint, channelFlags).search(channel)
-		if not channelsMatch:
-			return
-		nicksMatch = re.compile(nicksConstraint, nickFlags).search(nick)
-		if not nicksMatch:
+class AsyncBot(Bot):
+	"""
+	Bot running on asyncio streams instead of a sender and a receive thread.
+	
+	connect(), disconnect(), reconnect() and waitForDisconnect() are coroutines and must be awaited
+	from a running event loop. All other commands can be called from the loop or from any thread.
+	Handlers may be coroutine functions; these are scheduled on the loop. Plain handlers registered
+	with thread=True run in the bot's handler pool, as with Bot.
+	"""
+	def __init__(self, nickname, password='', *args, **kwargs):
+		super(AsyncBot, self).__init__(nickname, password, *args, **kwargs)
+		
+		self._loop = None
+		self._asyncDisconnectEvent = None
+		# asyncio only keeps weak references to tasks, so fire-and-forget tasks are held here until they finish
+		self._tasks = set()
+	
+	async def connect(self, host, port=6667, verbose=True, sleepTime=0.8, maxItems=10, channels=[], burst=4, registerTimeout=30):
+		"""
+		Connects the bot to a server. See Bot.connect() for the arguments.
+		Returns once the server has accepted the connection and the channels have been joined.
+		"""
+		if not self._beginConnect(host, port, verbose, sleepTime, maxItems, channels, burst, registerTimeout):
 			return
-		clientsMatch = re.compile(clientsConstraint, clientFlags).search(client)
-		if not clientsMatch:
-			return		
-		function(channel, nick, client)
+		
+		self._loop = asyncio.get_running_loop()
+		if self._asyncDisconnectEvent is None:
+			self._asyncDisconnectEvent = asyncio.Event()
+		
+		self._s = _AsyncSuperSocket(self._loop, self._sleepTime, self._maxItems, self._verbose, self._burst)
+		self._s._shutdownEvent.connect(self._socketDied)
+		startTime = time.monotonic()
+		attempt = 0
+		while not await self._s._connect(self._host, self._port):
+			attempt += 1
+			await asyncio.sleep(self._retryDelay(attempt))
+		self._register(startTime, attempt + 1)
+		
+		# Run the main loop as a task
+		self._receiver = _BotReceiver(self, self._verbose)
+		self._connectReceiver(self._receiver)
+		self._receiveTask = self._loop.create_task(self._receiveLoop())
+		
+		# Wait until the server is ready, then verify Nick
+		self._registrationWaited('ready', await self._waitRegistration('ready'))
+		if self._pass:
+			self.verifyNick(self._pass)
+			self._registrationWaited('identified', await self._waitRegistration('identified'))
+		
+		self._finishConnect(channels)
+	
+	async def disconnect(self, message=''):
+		"""
+		Disconnects the bot from the server.
+		
+		Arguments:
+		- message: Message to show when quitting.
+		"""
+		await self._shutdown(message)
+		# Fire disconnected event
+		self._disconnectEvent.set()
+		self._asyncDisconnectEvent.set()
+	
+	async def reconnect(self, message='', rejoin=True):
+		"""
+		Reconnects the bot to the server.
+		
+		Arguments:
+		- message: Message to show when quitting.
+		- rejoin: Rejoin channels
+		"""
+		chanlist = list(self._channels.keys()) if rejoin else []
+		await self._shutdown(message)
+		await self.connect(self._host, self._port, self._verbose, self._sleepTime, self._maxItems, chanlist, burst=self._burst, registerTimeout=self._registerTimeout)
+	
+	async def waitForDisconnect(self):
+		"""
+		Waits until the bot has disconnected.
+		"""
+		await self._asyncDisconnectEvent.wait()
+	
+	def addMsgHandler(self, function, *args, **kwargs):
+		if asyncio.iscoroutinefunction(function):
+			kwargs['thread'] = False
+		return super(AsyncBot, self).addMsgHandler(function, *args, **kwargs)
+	addMsgHandler.__doc__ = Bot.addMsgHandler.__doc__
+	
+	def addJoinHandler(self, function, *args, **kwargs):
+		if asyncio.iscoroutinefunction(function):
+			kwargs['thread'] = False
+		return super(AsyncBot, self).addJoinHandler(function, *args, **kwargs)
+	addJoinHandler.__doc__ = Bot.addJoinHandler.__doc__
+	
+	def addPartHandler(self, function, *args, **kwargs):
+		if asyncio.iscoroutinefunction(function):
+			kwargs['thread'] = False
+		return super(AsyncBot, self).addPartHandler(function, *args, **kwargs)
+	addPartHandler.__doc__ = Bot.addPartHandler.__doc__
+	
+	def addNamesHandler(self, function, *args, **kwargs):
+		if asyncio.iscoroutinefunction(function):
+			kwargs['thread'] = False
+		return super(AsyncBot, self).addNamesHandler(function, *args, **kwargs)
+	addNamesHandler.__doc__ = Bot.addNamesHandler.__doc__
+	
+	def addModeHandler(self, function, *args, **kwargs):
+		if asyncio.iscoroutinefunction(function):
+			kwargs['thread'] = False
+		return super(AsyncBot, self).addModeHandler(function, *args, **kwargs)
+	addModeHandler.__doc__ = Bot.addModeHandler.__doc__
+	
+	"""
+	Internal functions
+	"""
+	
+	def _resetState(self, channels):
+		super(AsyncBot, self)._resetState(channels)
+		self._asyncRegistration = {'welcome': asyncio.Event(), 'ready': asyncio.Event(), 'identified': asyncio.Event()}
+	
+	def _registrationStep(self, step):
+		super(AsyncBot, self)._registrationStep(step)
+		self._asyncRegistration[step].set()
+		if step == 'ready':
+			self._asyncRegistration['welcome'].set()
+	
+	async def _waitRegistration(self, step):
+		try:
+			await asyncio.wait_for(self._asyncRegistration[step].wait(), self._registerTimeout)
+			return True
+		except asyncio.TimeoutError:
+			return False
+	
+	async def _receiveLoop(self):
+		while not self._receiver._quit:
+			lines = await self._s._recv()
+			if lines is None:
+				self._receiver._die()
+				break
+			
+			for line in lines:
+				if self._verbose:
+					_logRecv(line)
+				
+				self._receiver._handleLine(line)
+	
+	async def _shutdown(self, message):
+		self._closing = True
+		self._s._send("QUIT :{}".format(message), PRIORITY_PROTOCOL)
+		# Wait for the receive task to be finished
+		try:
+			await asyncio.wait_for(asyncio.shield(self._receiveTask), 5)
+		except asyncio.TimeoutError:
+			self._receiveTask.cancel()
+		self._s._close()
+		self._connected = False
+		self._closing = False
+	
+	def _socketDied(self):
+		if self._connected and not self._connecting and not self._closing:
+			self._diedAt = time.monotonic()
+			self._connectStats['reconnects'] += 1
+			self._startTask(self.reconnect())
+	
+	def _runHandler(self, func, args, key=None):
+		if func['thread']:
+			# Runs on the asyncio loop, which must not wait for the pool
+			self._handlerPool.submit(func['func'], args, key, False)
+		else:
+			result = func['func'](*args)
+			if asyncio.iscoroutine(result):
+				self._startTask(result)
+	
+	def _startTask(self, coro):
+		task = self._loop.create_task(coro)
+		self._tasks.add(task)
+		task.add_done_callback(self._tasks.discard)
+		return task
@@ -23,24 +23,198 @@ __version__ = '3.7.0'
 import pythonircbot
 import configparser
 import os
-import time
 import random
 import sqlite3
 import json
+import sys
+import time
+import tempfile
+import shutil
+import threading
+import traceback
+import collections
 from datetime import timedelta
 from urllib.request import urlopen
 from xml.dom.minidom import parseString
 
 
+# Web lookups (wiki searches, video info) are cached for every bot in the process: url -> (time fetched, body)
+urlCache = collections.OrderedDict()
+urlCacheLock = threading.Lock()
+urlCacheSize = 256
+urlCacheSeconds = 300
+
+
+class modeStore():
+    '''Access to the chanmode table (auto-modes set on join). All stored modes are kept in memory after load, and changes are written back in batches. Each thread keeps one open connection to the database, which is created or upgraded on first use.'''
+    
+    # Bump when the schema changes and add the upgrade step to checkSchema
+    schemaVersion = 1
+    
+    def __init__(self, db, writeDelay = 1.0):
+        self.db = db
+        self.local = threading.local()
+        self.connections = []
+        self.connectionsLock = threading.Lock()
+        self.schemaChecked = False
+        # Every stored mode, channel -> {nick: mode}. Lookups are answered from here; the table is only read by load.
+        self.modes = {}
+        self.modesLock = threading.Lock()
+        # Changes not yet written: (channel, nick) -> mode, or None for a removal
+        self.pending = {}
+        self.writeTimer = None
+        self.writeLock = threading.Lock()
+        self.writeDelay = writeDelay
+        # Flushes run on whichever thread calls them (usually a timer thread), so they share one connection
+        self.writeConn = None
+    
+    def connection(self):
+        '''Returns this thread's connection, opening it if needed.'''
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.openConnection()
+            self.local.conn = conn
+        return conn
+    
+    def openConnection(self):
+        '''Opens a new connection to the database, checking the schema the first time.'''
+        # Waits up to 10 seconds on a locked database instead of failing
+        conn = sqlite3.connect(self.db, timeout = 10, isolation_level = None, check_same_thread = False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        with self.connectionsLock:
+            self.connections.append(conn)
+            if not self.schemaChecked:
+                self.checkSchema(conn)
+                self.schemaChecked = True
+        return conn
+    
+    def checkSchema(self, conn):
+        '''Creates the chanmode table, or upgrades one written by an older version, according to the database's user_version.'''
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version >= self.schemaVersion:
+            return
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            old = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='chanmode'").fetchone()
+            if old:
+                conn.execute('ALTER TABLE chanmode RENAME TO chanmode_v0')
+            conn.execute('''CREATE TABLE chanmode
+            (channel text NOT NULL, nick text NOT NULL, mode text NOT NULL, PRIMARY KEY (channel, nick)) WITHOUT ROWID''')
+            if old:
+                # Version 0 had no key, so a nick could have several rows; keep the highest mode. Nicks were stored as typed.
+                conn.execute('''INSERT INTO chanmode
+                SELECT lower(channel), lower(nick), substr('vho', max(instr('vho', mode)), 1) FROM chanmode_v0
+                WHERE mode IN ('v', 'h', 'o') GROUP BY lower(channel), lower(nick)''')
+                conn.execute('DROP TABLE chanmode_v0')
+            conn.execute('PRAGMA user_version = {}'.format(self.schemaVersion))
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+    
+    def load(self):
+        '''Reads every stored mode into memory.'''
+        modes = {}
+        for channel, nick, mode in self.connection().execute('SELECT channel, nick, mode FROM chanmode'):
+            modes.setdefault(channel, {})[nick] = mode
+        with self.modesLock:
+            self.modes = modes
+    
+    def get(self, channel, nick):
+        '''Returns the stored mode for nick in channel, or an empty string. Never touches the disk.'''
+        return self.modes.get(channel.lower(), {}).get(nick.lower(), '')
+    
+    def channelModes(self, channel):
+        '''Returns a copy of the stored modes for channel, nick -> mode. Never touches the disk.'''
+        with self.modesLock:
+            return dict(self.modes.get(channel.lower(), {}))
+    
+    def set(self, channel, nick, mode):
+        '''Stores mode ('v', 'h' or 'o') for nick in channel, unless a higher mode is already stored. A mode of '-v', '-h' or '-o' removes that mode if it is the one stored. Takes effect in memory right away; the table is updated a moment later, together with any other changes made in the meantime.'''
+        channel = channel.lower()
+        nick = nick.lower()
+        with self.modesLock:
+            current = self.modes.get(channel, {}).get(nick, '')
+            if mode[0] == '-':
+                if current == '' or mode[1] != current:
+                    return
+                del self.modes[channel][nick]
+                self.pending[(channel, nick)] = None
+            elif mode in ('v', 'h', 'o'):
+                if current != '' and 'vho'.index(current) >= 'vho'.index(mode):
+                    return
+                self.modes.setdefault(channel, {})[nick] = mode
+                self.pending[(channel, nick)] = mode
+            else:
+                return
+            if self.writeTimer is None:
+                self.writeTimer = threading.Timer(self.writeDelay, self.flush)
+                self.writeTimer.start()
+    
+    def flush(self):
+        '''Writes changes that are only in memory to the table now, in one transaction.'''
+        with self.writeLock:
+            with self.modesLock:
+                if self.writeTimer is not None:
+                    self.writeTimer.cancel()
+                    self.writeTimer = None
+                pending = self.pending
+                self.pending = {}
+            if not pending:
+                return
+            if self.writeConn is None:
+                self.writeConn = self.openConnection()
+            conn = self.writeConn
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                conn.executemany('''INSERT INTO chanmode VALUES (?,?,?)
+                ON CONFLICT (channel, nick) DO UPDATE SET mode = excluded.mode''', [(channel, nick, mode) for (channel, nick), mode in pending.items() if mode is not None])
+                conn.executemany('DELETE FROM chanmode WHERE channel=? AND nick=?', [key for key, mode in pending.items() if mode is None])
+                conn.execute('COMMIT')
+            except:
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+                # Put the batch back, behind anything changed since, and try again later
+                with self.modesLock:
+                    pending.update(self.pending)
+                    self.pending = pending
+                    if self.writeTimer is None:
+                        self.writeTimer = threading.Timer(self.writeDelay, self.flush)
+                        self.writeTimer.start()
+                raise
+    
+    def close(self):
+        '''Writes any pending changes, then closes every connection opened by this store.'''
+        self.flush()
+        with self.connectionsLock:
+            for conn in self.connections:
+                conn.close()
+            self.connections = []
+        self.local = threading.local()
+        self.writeConn = None
+
 
 class snaibot():
-    def __init__(self, configfile):
-        '''Initializes snaibot object. Requires only the filename for a settings.ini file in the same folder, which it will either read from (if found) or build (if not found). Default settings.ini file will not be sufficient to run bot program and will require configuration.'''
+    def __init__(self, configfile, loop = None, block = True):
+        '''Initializes snaibot object. Requires only the filename for a settings.ini file in the same folder, which it will either read from (if found) or build (if not found). Default settings.ini file will not be sufficient to run bot program and will require configuration. A supervisor running several bots passes its shared SelectorLoop as loop and block = False, so this returns once the bot is up instead of waiting for it to disconnect.'''
         
         self.config = configparser.ConfigParser()
         self.configfile = configfile
+        self.configStamp = None
+        self.configLock = threading.RLock()
+        self.moduleSet = None
+        # Runtime edits: (section, option) -> (value, version). Kept until saved, so a reload of the file does not undo them.
+        self.configPending = {}
+        self.configVersion = 0
+        self.configSavedVersion = 0
+        self.configSaveTimer = None
+        self.configSaveLock = threading.Lock()
+        self.configSaveDelay = 2.0
         self.tryBuildConfig(True)
         self.db = self.config['SERVER']['botName']+ '-' + self.config['SERVER']['server'] + '.snaidb'
+        self.modeStore = modeStore(self.db)
+        self.modeStore.load()
         
         self.microLog = {}
         self.msgmodulestate = {}
@@ -56,6 +230,26 @@ class snaibot():
                             'youtube':self.ytInfo,
                             'calculator':self.calculator,
                             'dice':self.diceRoll}
+        
+        # Command words for msg modules. Modules listed here are only called by commandDispatch when a line
+        # starts with one of their words. Modules not listed in any of these are passive and see every line.
+        self.msgmoduletriggers = {'news':['*news'],
+                                  'admin':['*admin', '*identify', '*join', '*leave', '*kick', '*v', '*h', '*o', '*dv', '*dh', '*do']}
+        
+        # Prefix commands also match when the argument is not separated by a space (e.g. *calc2+2)
+        self.msgmoduleprefixes = {'choose':['*choose'],
+                                  'wiki':['*atlwiki', '*fullatlwiki'],
+                                  'calculator':['*calc'],
+                                  'dice':['*dice']}
+        
+        # Keyword modules are called when the line (minus its first character) is a key in their config section
+        self.msgmodulekeywords = {'normal links':'Keyword Links',
+                                  'secret links':'Secret Links'}
+        
+        # Commands that are always available, whatever modules are enabled
+        self.corecommands = {'*more':self.showMore}
+        
+        self.commandIndex = ({}, [], [])
                             
         self.joinmodulestate = {}
         
@@ -65,16 +259,26 @@ class snaibot():
         
         self.partmoduleref = {}
         
-        self.bot = pythonircbot.Bot(self.config['SERVER']['botName'], self.config['SERVER']['password'])
-        self.bot.connect(self.config['SERVER']['server'], verbose = True)
+        # Names modules run when the member list of a channel is complete, mode modules on user mode changes
+        self.namesmodulestate = {}
+        
+        self.namesmoduleref = {'auto mode':self.autoModeSweep}
+        
+        self.modemodulestate = {}
         
-        os.system("title {} on {} in channels: {}".format(self.config['SERVER']['botName'], self.config['SERVER']['server'], self.config['SERVER']['channels'].replace(',', ', ')))
+        self.modemoduleref = {'auto mode':self.autoModeOpped}
         
-        time.sleep(int(self.config['SERVER']['timeout']))
+        # Log is written by a background thread. With several bots in one process, the first bot's settings are used.
+        pythonircbot.startLogging(filename = self.config['SERVER'].get('log file', '') or None, recvSample = int(self.config['SERVER'].get('recv log sample', '1')))
         
-        for channel in self.confListParser(self.config['SERVER']['channels']):
-            self.bot.joinChannel(channel)
-            print(self.bot._channels)
+        self.bot = pythonircbot.Bot(self.config['SERVER']['botName'], self.config['SERVER']['password'])
+        # Returns as soon as the server is ready and NickServ has accepted the password (or timeout seconds have passed)
+        self.bot.connect(self.config['SERVER']['server'], verbose = True, registerTimeout = int(self.config['SERVER']['timeout']), loop = loop)
+        
+        if block:
+            os.system("title {} on {} in channels: {}".format(self.config['SERVER']['botName'], self.config['SERVER']['server'], self.config['SERVER']['channels'].replace(',', ', ')))
+        
+        self.bot.joinChannels(self.confListParser(self.config['SERVER']['channels']))
         
         self.microLog = {}
         self.microSwearLog = {}
@@ -82,63 +286,35 @@ class snaibot():
         self.updateModules()
         
         self.bot.addMsgHandler(self.help)
+        self.bot.addMsgHandler(self.commandDispatch)
         
-        self.bot.waitForDisconnect()
-
-    def checkSQLDatabase(self):
-        '''Verifies SQL database exists. If not, creates db and basic table'''
-        if not os.path.exists(self.db):
-            conn = sqlite3.connect(self.db)
-            conn.isolation_level = None
-            done = False
-            while done != True:
-                c = conn.cursor()
-                c.execute('''CREATE TABLE chanmode
-                (channel text, nick text, mode text)''')
-                done = True
-            conn.close()
-    
+        if block:
+            self.bot.waitForDisconnect()
+
     def updateSQLTableCM(self, channel, nick, mode):
         '''Updates SQL table for auto-mode set on join.'''
-        self.checkSQLDatabase()
-        conn = sqlite3.connect(self.db)
-        conn.isolation_level = None
-        done = False
-        hier = {'v':1, 'h':2, 'o':3}
-        while done != True:
-            try:
-                c = conn.cursor()
-                c.execute("SELECT mode FROM chanmode WHERE channel=? AND nick=?",(channel, nick))
-                try:
-                    test = str(c.fetchall()[0][0])
-                    if mode[0] == '-':
-                        if mode[1] == test:
-                            c.execute("""DELETE FROM chanmode WHERE channel=? AND nick=?""", (channel, nick))
-                    elif hier[test] < hier[mode]:
-                        c.execute("""UPDATE chanmode 
-                        SET mode = ?
-                        WHERE channel=? AND nick=?;""",(mode, channel, nick))
-                except:
-                    if mode[0] in ['v', 'h', 'o']:
-                        c.execute("""INSERT INTO chanmode VALUES (?,?,?)""", (channel, nick, mode))
-                done = True
-            except:
-                continue
-        conn.close()
+        self.modeStore.set(channel, nick, mode)
     
     def modeSQLCheck(self, channel, nick):
-        self.checkSQLDatabase()
-        conn = sqlite3.connect(self.db)
-        try:
-            c = conn.cursor()
-            c.execute("SELECT mode FROM chanmode WHERE channel=? AND nick=?",(channel, nick))
-            mode = str(c.fetchall()[0][0])
-            conn.close()
-            return mode
-        except:
-            conn.close()
-            return ''
+        '''Micro function to return the auto-mode stored for nick in channel (empty string if none).'''
+        return self.modeStore.get(channel, nick)
 
+    def fetchURL(self, url):
+        '''Returns the body of the web page at url. Pages fetched in the last few minutes by any bot in this process are served from a shared cache. Gives up after the server timeout from the config, so a hung site cannot hold a handler worker forever.'''
+        
+        now = time.monotonic()
+        with urlCacheLock:
+            if url in urlCache and now - urlCache[url][0] < urlCacheSeconds:
+                urlCache.move_to_end(url)
+                return urlCache[url][1]
+        body = urlopen(url, timeout = int(self.config['SERVER']['timeout'])).read()
+        with urlCacheLock:
+            urlCache[url] = (now, body)
+            urlCache.move_to_end(url)
+            while len(urlCache) > urlCacheSize:
+                urlCache.popitem(last = False)
+        return body
+    
     def getTestMsg(self, nick, msg):
         '''New function to allow parsing of msg from IRC bot for gameserver. Takes a msg and original sending nick and attempts to parse out a message and nick from a CraftIRC bot. Returns a tuple of (nick, lowermsg, origmsg)'''
         
@@ -153,14 +329,16 @@ class snaibot():
         
         
     def tryBuildConfig(self, firstRun = False):
-        '''Attempts to find the config file. Will load if found or build a default if not found.'''
+        '''Attempts to find the config file. Will load if found or build a default if not found. After the first run the file is only read again when it has changed (see reloadConfig). Returns True if the config was (re)loaded.'''
         
         if firstRun == True:
             self.config['SERVER'] = {'botName': 'snaibot',
                                     'server': '',
                                     'channels': '',
                                     'password':'',
-                                    'timeout':'10'}
+                                    'timeout':'10',
+                                    'log file':'',
+                                    'recv log sample':'1'}
                 
             self.config['Modules'] = {'Normal Links':'False',
                                     'Secret Links':'False',
@@ -191,20 +369,115 @@ class snaibot():
         if not os.path.exists(self.configfile):
             print('Building Default settings.ini file...')
                       
-            with open(self.configfile, 'w') as confile:
-                self.config.write(confile)
-                confile.close()
+            self.writeConfigFile(self.config)
             print('Basic settings.ini file built. Please configure and restart bot...')
+            return True
             
-        else:
-            self.config.remove_section('Mod Links')
-            self.config.remove_section('Keyword Links')
-            self.config.remove_section('Secret Links')
+        elif firstRun == True:
             self.config.read(self.configfile)
-            if firstRun == True:
-                with open(self.configfile, 'w') as confile:
-                    self.config.write(confile)
-                    confile.close()
+            self.writeConfigFile(self.config)
+            self.configStamp = self.configSignature()
+            return True
+        
+        else:
+            return self.reloadConfig()
+    
+    def configSignature(self):
+        '''Micro function returning the modification time and size of the config file, or None if it is missing. A different signature means the file has changed.'''
+        
+        try:
+            stat = os.stat(self.configfile)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+    
+    def reloadConfig(self):
+        '''Reads the config file again if it changed since the last read. The settings are parsed into a new ConfigParser that then replaces self.config in one step, so modules running at the same time never see a half-read config. Returns True if the config was reloaded.'''
+        
+        # Stat before reading, so a change made while reading is picked up by the next check
+        signature = self.configSignature()
+        if signature is None or signature == self.configStamp:
+            return False
+        with self.configLock:
+            config = self.copyConfig()
+            # Link sections are replaced as a whole, so links deleted from the file go away
+            config.remove_section('Mod Links')
+            config.remove_section('Keyword Links')
+            config.remove_section('Secret Links')
+            config.read(self.configfile)
+            for (section, option), (value, version) in self.configPending.items():
+                if not config.has_section(section):
+                    config.add_section(section)
+                config.set(section, option, value)
+            self.config = config
+            self.configStamp = signature
+        return True
+    
+    def copyConfig(self):
+        '''Micro function returning a new ConfigParser with the same raw (not interpolated) settings as self.config.'''
+        
+        config = configparser.ConfigParser()
+        config.read_dict(dict((section, dict(self.config.items(section, raw = True))) for section in self.config.sections()))
+        return config
+    
+    def setConfig(self, section, option, value):
+        '''Changes one setting at runtime. The change is visible right away. It is written to the config file a few seconds later, together with any other changes made in the meantime, so handlers never wait for the disk. Returns the new config version.'''
+        
+        with self.configLock:
+            config = self.copyConfig()
+            if not config.has_section(section):
+                config.add_section(section)
+            config.set(section, option, value)
+            self.config = config
+            self.configVersion += 1
+            self.configPending[(section, option)] = (value, self.configVersion)
+            if self.configSaveTimer is None:
+                self.configSaveTimer = threading.Timer(self.configSaveDelay, self.saveConfig)
+                self.configSaveTimer.start()
+            return self.configVersion
+    
+    def saveConfig(self):
+        '''Writes runtime changes to the config file now, if there are any that are not saved yet.'''
+        
+        with self.configSaveLock:
+            with self.configLock:
+                if self.configSaveTimer is not None:
+                    self.configSaveTimer.cancel()
+                    self.configSaveTimer = None
+                if self.configSavedVersion == self.configVersion:
+                    return
+                # Pick up hand edits made since the last read, or the write below would undo them
+                if self.reloadConfig():
+                    # The stamp is about to move past this read, so make the next updateModules check the modules
+                    self.moduleSet = None
+                config = self.config
+                version = self.configVersion
+            self.writeConfigFile(config)
+            with self.configLock:
+                self.configSavedVersion = version
+                self.configStamp = self.configSignature()
+                for key, (value, changed) in list(self.configPending.items()):
+                    if changed <= version:
+                        del self.configPending[key]
+    
+    def writeConfigFile(self, config):
+        '''Writes config to the config file atomically: it goes to a temporary file in the same folder that then replaces the config file, so the file is never seen half-written.'''
+        
+        folder = os.path.dirname(os.path.abspath(self.configfile))
+        handle, temp = tempfile.mkstemp(dir = folder, prefix = '.' + os.path.basename(self.configfile) + '-', suffix = '.tmp')
+        try:
+            with os.fdopen(handle, 'w') as confile:
+                config.write(confile)
+                confile.flush()
+                os.fsync(confile.fileno())
+            # mkstemp makes the file private (0600); keep the permissions the config file had
+            if os.path.exists(self.configfile):
+                shutil.copymode(self.configfile, temp)
+            os.replace(temp, self.configfile)
+        except:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
             
             
     def confListParser(self, configList):
@@ -215,38 +488,37 @@ class snaibot():
     
     def opsListBuilder(self, channel, level = 'o'):
         '''Scans the channel and returns a set containing all people with elevated privledges in the channel specified. Level allows specification of minimum priledge level to include. Default will be "o" (OPS+), but other options will be "v" (Voice+), "h" (HOPS+), "a" (AOPS+), and "own" (Owner only). Note that some servers only consider some of these (some only use OP and Voice, in which case use of "h" would still only include Voice).'''
+        return self.bot.getNamesWithMode(channel, self.levelMode(level), orHigher=True)
+    
+    def levelMode(self, level):
+        '''Micro function to convert a privledge level as used by opsListBuilder into its prefix mode letter. Unrecognized levels become "o".'''
+        
         lev = level.lower()
-        namelist = set()
-        if lev not in ['own','a','o','h','v']:
-            lev = 'o' #conditional to force OP+ if level unrecognized
-        
-        if lev == 'v':
-            namelist.update(self.bot.getVoices(channel))
-            namelist.update(self.bot.getHops(channel))
-            namelist.update(self.bot.getOps(channel))
-            namelist.update(self.bot.getAops(channel))
-            namelist.update(self.bot.getOwner(channel))
-        elif lev == 'h':
-            namelist.update(self.bot.getHops(channel))
-            namelist.update(self.bot.getOps(channel))
-            namelist.update(self.bot.getAops(channel))
-            namelist.update(self.bot.getOwner(channel))
-        elif lev == 'o':
-            namelist.update(self.bot.getOps(channel))
-            namelist.update(self.bot.getAops(channel))
-            namelist.update(self.bot.getOwner(channel))
-        elif lev == 'a':
-            namelist.update(self.bot.getAops(channel))
-            namelist.update(self.bot.getOwner(channel))
-        elif lev == 'own':
-            namelist.update(self.bot.getOwner(channel))
-        return namelist    
+        if lev == 'own':
+            return 'q'
+        if lev not in ['a','o','h','v']:
+            return 'o' #conditional to force OP+ if level unrecognized
+        return lev
+    
+    def hasLevel(self, channel, nick, level = 'o'):
+        '''Checks whether a nick has at least the privledge level specified in the channel, using the same levels as opsListBuilder.'''
+        
+        return self.bot.hasMode(channel, nick, self.levelMode(level), orHigher=True)
     
     
     def updateModules(self):
-        '''NEW TO SNAIBOT 3.0: This will form the backbone of the new modular design. This will update the settings from the config and attempt to turn on or off modules based on those settings. If a module is not properly marked as true or false in the config, it will set it to false automatically.'''
+        '''NEW TO SNAIBOT 3.0: This will form the backbone of the new modular design. This will update the settings from the config and attempt to turn on or off modules based on those settings. If a module is not properly marked as true or false in the config, it will set it to false automatically. Handlers are only re-wired when the Modules section actually changed.'''
         
-        self.tryBuildConfig()
+        with self.configLock:
+            if not self.tryBuildConfig() and self.moduleSet is not None:
+                return
+            moduleSet = frozenset(self.config['Modules'].items())
+            if moduleSet != self.moduleSet:
+                self.wireModules()
+                self.moduleSet = frozenset(self.config['Modules'].items())
+    
+    def wireModules(self):
+        '''Turns msg, join, part, names and mode modules on or off to match the Modules section of the config. Called by updateModules.'''
         
         modules = self.config['Modules']
         
@@ -256,17 +528,21 @@ class snaibot():
                     try:
                         test = self.msgmodulestate[module]
                     except:
-                        self.msgmodulestate[module] = self.bot.addMsgHandler(self.msgmoduleref[module])
+                        if self.isCommandModule(module):
+                            self.msgmodulestate[module] = None
+                        else:
+                            self.msgmodulestate[module] = self.bot.addMsgHandler(self.msgmoduleref[module])
                 elif modules[module].lower() == 'false':
                     try:
-                        self.bot.removeMsgHandler(self.msgmodulestate.pop(module))
+                        handler = self.msgmodulestate.pop(module)
+                        if handler is not None:
+                            self.bot.removeMsgHandler(handler)
                     except:
                         pass
             else:
-                self.config['Modules'][module] = 'False'
-                with open(self.configfile, 'w') as configfile:
-                    self.config.write(configfile)
-                    configfile.close()
+                self.setConfig('Modules', module, 'False')
+        
+        self.buildCommandIndex()
                     
         for module in self.joinmoduleref.keys():
             if modules[module].lower() == 'true' or modules[module].lower() == 'false':
@@ -281,10 +557,7 @@ class snaibot():
                     except:
                         pass
             else:
-                self.config['Modules'][module] = 'False'
-                with open(self.configfile, 'w') as configfile:
-                    self.config.write(configfile)
-                    configfile.close()
+                self.setConfig('Modules', module, 'False')
                     
         for module in self.partmoduleref.keys():
             if modules[module].lower() == 'true' or modules[module].lower() == 'false':
@@ -299,11 +572,58 @@ class snaibot():
                     except:
                         pass
             else:
-                self.config['Modules'][module] = 'False'
-                with open(self.configfile, 'w') as configfile:
-                    self.config.write(configfile)
-                    configfile.close()
+                self.setConfig('Modules', module, 'False')
+        
+        for module in self.namesmoduleref.keys():
+            if modules[module].lower() == 'true' or modules[module].lower() == 'false':
+                if modules[module].lower() == 'true':
+                    try:
+                        test = self.namesmodulestate[module]
+                    except:
+                        self.namesmodulestate[module] = self.bot.addNamesHandler(self.namesmoduleref[module])
+                elif modules[module].lower() == 'false':
+                    try:
+                        self.bot.removeNamesHandler(self.namesmodulestate.pop(module))
+                    except:
+                        pass
+            else:
+                self.setConfig('Modules', module, 'False')
+        
+        for module in self.modemoduleref.keys():
+            if modules[module].lower() == 'true' or modules[module].lower() == 'false':
+                if modules[module].lower() == 'true':
+                    try:
+                        test = self.modemodulestate[module]
+                    except:
+                        # Only ops and halfops given to anyone matter here; the module checks for the bot's own nick
+                        self.modemodulestate[module] = self.bot.addModeHandler(self.modemoduleref[module], mode = '^[oh]$')
+                elif modules[module].lower() == 'false':
+                    try:
+                        self.bot.removeModeHandler(self.modemodulestate.pop(module))
+                    except:
+                        pass
+            else:
+                self.setConfig('Modules', module, 'False')
 
+    def isCommandModule(self, module):
+        '''Returns True if the msg module is reached through commandDispatch rather than its own handler.'''
+        return module in self.msgmoduletriggers or module in self.msgmoduleprefixes or module in self.msgmodulekeywords
+    
+    def buildCommandIndex(self):
+        '''Rebuilds the command lookup tables used by commandDispatch from the enabled msg modules.'''
+        exact = dict(self.corecommands)
+        prefixes = {}
+        keywords = []
+        for module in self.msgmodulestate.keys():
+            for word in self.msgmoduletriggers.get(module, []):
+                exact[word] = self.msgmoduleref[module]
+            for word in self.msgmoduleprefixes.get(module, []):
+                prefixes.setdefault(len(word), {})[word] = self.msgmoduleref[module]
+            if module in self.msgmodulekeywords:
+                keywords.append((self.msgmodulekeywords[module], self.msgmoduleref[module]))
+        # Longest prefixes first, so *fullatlwiki is not shadowed by a shorter command
+        self.commandIndex = (exact, sorted(prefixes.items(), reverse=True), keywords)
+    
     def stripped(self, x):
         '''Helper function for the language filter. Strips extra-extraneous characters from string x and returns it.'''
         return "".join([i for i in x if ord(i) in range(32, 127)])
@@ -322,6 +642,45 @@ class snaibot():
         self.bot.sendMsg(channel, msg)
         
         
+    def commandDispatch(self, msg, channel, nick, client, msgMatch):
+        '''Looks up the first word of a message in the command index and calls only the module registered for it. Always runs; ordinary chat lines stop here.'''
+        
+        testmsg = self.getTestMsg(nick, msg)[1]
+        words = testmsg.split(None, 1)
+        if not words:
+            return
+        exact, prefixes, keywords = self.commandIndex
+        module = exact.get(words[0])
+        if module is None:
+            for length, commands in prefixes:
+                module = commands.get(testmsg[:length])
+                if module is not None:
+                    break
+        if module is not None:
+            module(msg, channel, nick, client, msgMatch)
+        
+        for section, module in keywords:
+            try:
+                if testmsg[1:] in self.config[section]:
+                    module(msg, channel, nick, client, msgMatch)
+            except KeyError:
+                pass
+    
+    def moreHint(self, target, remaining):
+        '''Tells target how to get the rest of a list that was cut off.'''
+        
+        if remaining > 0:
+            self.bot.sendMsg(target, '({} more line{}, type *more)'.format(remaining, '' if remaining == 1 else 's'))
+    
+    def showMore(self, msg, channel, nick, client, msgMatch):
+        '''Sends the next page of the last cut off list sent to the channel, or to the nick in query.'''
+        
+        nick = self.getTestMsg(nick, msg)[0]
+        for target in [channel, nick]:
+            if self.bot.hasMore(target):
+                self.moreHint(target, self.bot.sendMore(target))
+                return
+    
     def help(self, msg, channel, nick, client, msgMatch):
         '''Builds help command based on loaded modules. This will always run regardless of other modules loaded.'''
         
@@ -332,7 +691,7 @@ class snaibot():
         msg = parsemsg[2]
         modules = self.config['Modules']
         if testmsg == '.help' or testmsg == '.commands' or testmsg == '.options' or testmsg == '*commands'or testmsg == '*options' or testmsg == '*help':
-            toSend = '*commands, *help'
+            toSend = '*commands, *help, *more'
             
             if modules['News'].lower() == 'true':
                 toSend = toSend + ', *news'
@@ -366,15 +725,11 @@ class snaibot():
         if testmsg.split(' ')[0] == '*news':
             try:
                 if testmsg.split(' ')[1] == 'edit':
-                    tryOPVoice = self.opsListBuilder(channel)
-                    if nick in tryOPVoice:
+                    if self.hasLevel(channel, nick):
                         news = ''
                         for i in msg.split(' ')[2:]:
                             news = news + ' ' + i
-                        self.config['NEWS']['News Item'] = news[1:]
-                        with open(self.configfile, 'w') as configfile:
-                            self.config.write(configfile)
-                            configfile.close()
+                        self.setConfig('NEWS', 'News Item', news[1:])
                         self.bot.sendMsg(channel, 'News Updated in Config!')
                             
                     else:
@@ -438,12 +793,9 @@ class snaibot():
         
         if channel.upper() in self.bot._channels:
             
-            tryOPVoice = self.opsListBuilder(channel,'v')
-            tryOP = self.opsListBuilder(channel, 'h')
-            
-            if self.bot._nick in tryOP:
+            if self.hasLevel(channel, self.bot._nick, 'h'):
             
-                if nick not in tryOPVoice:
+                if not self.hasLevel(channel, nick, 'v'):
                     
                     msg = msg.lower()
                 
@@ -480,12 +832,9 @@ class snaibot():
         
         if channel.upper() in self.bot._channels:
             
-            tryOPVoice = self.opsListBuilder(channel,'v')
-            tryOP = self.opsListBuilder(channel, 'h')
+            if self.hasLevel(channel, self.bot._nick, 'h'):            
             
-            if self.bot._nick in tryOP:            
-            
-                if nick not in tryOPVoice:    
+                if not self.hasLevel(channel, nick, 'v'):    
                     
                     msg = msg.lower()
                     msg = self.stripped(msg)
@@ -536,9 +885,8 @@ class snaibot():
         configAdmin = self.confListParser(self.config['Admin']['Admin Nicks'])
         try:
             if channel.upper() in self.bot._channels:
-                chanOPList = self.opsListBuilder(channel)
-                if self.bot._nick in chanOPList:
-                    if nick in configAdmin or nick in chanOPList:
+                if self.hasLevel(channel, self.bot._nick):
+                    if nick in configAdmin or self.hasLevel(channel, nick):
                         if testmsg == '*admin':
                             self.bot.sendMsg(nick, 'The following administrative commands are available in {}: Set modes (*v <nick>, *h <nick>, *o <nick>), Un-set Modes (*dv <nick>, *dh <nick>, *do <nick>), *kick <nick>, *join <channel>, *leave <channel>, *identify'.format(channel))     
                         elif testmsg == '*identify':
@@ -643,13 +991,14 @@ class snaibot():
                         searchTerm = searchTerm + '%20' + term
                     baseurl = "http://atlwiki.net/api.php?format=json&action=query&list=search&srsearch={}&srwhat=title"
                     qurl = baseurl.format(searchTerm)
-                    openurl = urlopen(qurl).read()
+                    openurl = self.fetchURL(qurl)
                     jsread = json.loads(openurl.decode('utf-8'))
                     numTitles = len(jsread['query']['search'])
                     if numTitles > 0:
                         self.bot.sendMsg(nick, "Full search results for " + searchTerm.replace('%20',' '))
-                        for i in jsread['query']['search']:
-                            self.bot.sendMsg(nick, i['title'] + '  -  http://atlwiki.net/{}'.format(i['title'].replace(' ', '_')))
+                        results = [i['title'] + '  -  http://atlwiki.net/{}'.format(i['title'].replace(' ', '_')) for i in jsread['query']['search']]
+                        remaining = self.bot.sendList(nick, results, separator = ' | ', priority = pythonircbot.PRIORITY_BULK)
+                        self.moreHint(nick, remaining)
                     else:
                         self.bot.sendMsg(channel, nick + ': No results found. If this page should exist, please consider contributing to the wiki! http://atlwiki.net')                    
                 else:
@@ -670,7 +1019,7 @@ class snaibot():
                         searchTerm = searchTerm + '%20' + term
                     baseurl = "http://atlwiki.net/api.php?format=json&action=query&list=search&srsearch={}&srwhat=title"
                     qurl = baseurl.format(searchTerm)
-                    openurl = urlopen(qurl).read()
+                    openurl = self.fetchURL(qurl)
                     jsread = json.loads(openurl.decode('utf-8'))
                     numTitles = len(jsread['query']['search'])
                     if numTitles > 0:
@@ -712,7 +1061,7 @@ class snaibot():
                 # Try to open gdata URL
                 try:
                     url = 'https://gdata.youtube.com/feeds/api/videos/{0}'.format(vidid)
-                    s = urlopen(url).read()
+                    s = self.fetchURL(url)
                     d = parseString(s)
                 except:
                     return
@@ -789,6 +1138,27 @@ class snaibot():
         mode = self.modeSQLCheck(channel, nick.lower())
         if mode in ['v', 'h', 'o']:
             self.bot.setMode(channel, nick, mode)
+    
+    def autoModeSweep(self, channel):
+        '''Module to promote users who are already in a channel to their assigned level, run once the bot has the channel's member list (after it joins or rejoins) and when it is given ops. Users who already have their level or a higher one are skipped, the rest are set several per MODE line. An OP can set all levels, a HOP only voice.'''
+        stored = self.modeStore.channelModes(channel)
+        if not stored:
+            return
+        if self.hasLevel(channel, self.bot._nick, 'o'):
+            allowed = ['v', 'h', 'o']
+        elif self.hasLevel(channel, self.bot._nick, 'h'):
+            allowed = ['v']
+        else:
+            return
+        for nick in self.bot.getNames(channel) or []:
+            mode = stored.get(nick.lower(), '')
+            if mode in allowed and not self.bot.hasMode(channel, nick, mode, orHigher=True):
+                self.bot.setMode(channel, nick, mode)
+    
+    def autoModeOpped(self, channel, nick, mode, sign):
+        '''Micro function to run autoModeSweep when the bot itself is given ops or halfops in a channel.'''
+        if sign == '+' and nick == self.bot._nick:
+            self.autoModeSweep(channel)
    
     
     def diceRoll(self, msg, channel, nick, client, msgMatch):
@@ -810,10 +1180,75 @@ class snaibot():
                             d = random.randint(1, numSides)
                             roll = roll + d
                             rolls.append(d)
-                        self.bot.sendMsg(channel, nick + ': Total value rolled was {} - Dice Rolled: {}'.format(roll, rolls))
+                        remaining = self.bot.sendList(channel, rolls, nick + ': Total value rolled was {} - Dice Rolled: '.format(roll), maxLines = 2)
+                        self.moreHint(channel, remaining)
                     else:
                         self.bot.sendMsg(channel, nick + ': Error: Invalid numbers. Please try again.')                    
                 else:
                     self.bot.sendMsg(channel, nick + ': Error: Non Digit Dice Values (#d# required)')
             else:
-                self.bot.sendMsg(channel, nick + ': Error: Invalid Format (#d# required)')
\ No newline at end of file
+                self.bot.sendMsg(channel, nick + ': Error: Invalid Format (#d# required)')
+
+
+
+class supervisor():
+    def __init__(self, configfiles, handlerWorkers = 8):
+        '''Runs one snaibot per config file in this process. All bots share one SelectorLoop for their connections, one pool of handler threads and the web lookup cache. Each bot still has its own config, database and flood control.'''
+        
+        self.loop = pythonircbot.SelectorLoop(handlerWorkers = handlerWorkers)
+        self.bots = {}
+        self.botsLock = threading.Lock()
+        
+        # Connecting waits for the server to finish registration, so all bots connect at the same time
+        starters = [threading.Thread(target = self.startBot, args = (configfile,)) for configfile in configfiles]
+        for t in starters:
+            t.start()
+        for t in starters:
+            t.join()
+    
+    def startBot(self, configfile):
+        '''Starts the bot for one config file. A bot that fails to start is reported and left out, the other bots keep running.'''
+        
+        try:
+            bot = snaibot(configfile, loop = self.loop, block = False)
+        except:
+            print('*** Could not start bot for {} ***'.format(configfile))
+            traceback.print_exc()
+            return None
+        with self.botsLock:
+            self.bots[configfile] = bot
+        return bot
+    
+    def restartBot(self, configfile):
+        '''Disconnects the bot for one config file and starts it again with a fresh read of its config. The other bots are not touched.'''
+        
+        with self.botsLock:
+            old = self.bots.pop(configfile, None)
+        if old is not None:
+            old.saveConfig()
+            old.bot.disconnect('Restarting')
+            old.modeStore.close()
+        return self.startBot(configfile)
+    
+    def waitForDisconnect(self):
+        '''Blocks until every bot has disconnected.'''
+        
+        while True:
+            with self.botsLock:
+                bots = list(self.bots.values())
+            if not bots:
+                return
+            for bot in bots:
+                bot.bot.waitForDisconnect()
+            # A bot restarted meanwhile is a new object, check again
+            with self.botsLock:
+                if all(bot in bots for bot in self.bots.values()):
+                    return
+
+
+if __name__ == '__main__':
+    # python snaibot.py first.ini second.ini ... runs all bots in this process
+    if len(sys.argv) < 2:
+        print('Usage: snaibot.py <configfile> [<configfile> ...]')
+    else:
+        supervisor(sys.argv[1:]).waitForDisconnect()
@@ -0,0 +1,91 @@
+#    Tests for pythonircbot. Run from this folder with: python -m unittest test_pythonircbot
+
+import unittest
+
+import pythonircbot
+
+# A NAMES burst and a few ordinary lines, as a server would send them
+_LINES = [
+	":irc.server 353 snaibot = #chan :@op +voice normal1 normal2 %hop " + ' '.join('user{}'.format(i) for i in range(60)),
+	":irc.server 366 snaibot #chan :End of /NAMES list.",
+	":alice!~a@host.example PRIVMSG #chan :hello there",
+	":bob!~b@other.example JOIN #chan",
+	"PING :irc.server",
+]
+_DATA = ''.join(line + '\r\n' for line in _LINES).encode()
+
+class LineFramerTest(unittest.TestCase):
+	def feedAll(self, framer, chunks):
+		lines = []
+		for chunk in chunks:
+			lines.extend(framer.feed(chunk))
+		return lines
+
+	def testByteAtATime(self):
+		framer = pythonircbot._LineFramer()
+		chunks = [_DATA[i:i + 1] for i in range(len(_DATA))]
+		self.assertEqual(self.feedAll(framer, chunks), _LINES)
+
+	def testLargeBurst(self):
+		framer = pythonircbot._LineFramer()
+		self.assertEqual(framer.feed(_DATA * 200), _LINES * 200)
+
+	def testBurstGrowsReadSize(self):
+		framer = pythonircbot._LineFramer()
+		start = framer.readSize
+		framer.feed(_DATA * 200)
+		self.assertGreater(framer.readSize, start)
+		for i in range(10):
+			framer.feed(b'PING :x\r\n')
+		self.assertEqual(framer.readSize, start)
+
+	def testSplitAtEveryOffset(self):
+		for i in range(len(_DATA) + 1):
+			framer = pythonircbot._LineFramer()
+			self.assertEqual(self.feedAll(framer, [_DATA[:i], _DATA[i:]]), _LINES)
+
+	def testCrLfSplitAcrossReads(self):
+		framer = pythonircbot._LineFramer()
+		self.assertEqual(framer.feed(b'PING :one\r'), [])
+		self.assertEqual(framer.feed(b'\nPING :two\r\n'), ['PING :one', 'PING :two'])
+
+	def testBareLf(self):
+		framer = pythonircbot._LineFramer()
+		self.assertEqual(framer.feed(b'PING :one\nPING :two\n'), ['PING :one', 'PING :two'])
+
+	def testUnterminatedTailIsKept(self):
+		framer = pythonircbot._LineFramer()
+		self.assertEqual(framer.feed(b'PING :one\r\nPING :tw'), ['PING :one'])
+		self.assertEqual(framer.feed(b'o\r\n'), ['PING :two'])
+
+	def testEmptyLinesAreSkipped(self):
+		framer = pythonircbot._LineFramer()
+		self.assertEqual(framer.feed(b'\r\n\r\nPING :x\r\n\n'), ['PING :x'])
+
+	def testMultiByteUtf8SplitAcrossReads(self):
+		line = ':alice!~a@host PRIVMSG #chan :héllo 日本語 \U0001f600'
+		data = (line + '\r\n').encode()
+		for i in range(len(data) + 1):
+			framer = pythonircbot._LineFramer()
+			self.assertEqual(self.feedAll(framer, [data[:i], data[i:]]), [line])
+		framer = pythonircbot._LineFramer()
+		self.assertEqual(self.feedAll(framer, [data[i:i + 1] for i in range(len(data))]), [line])
+
+	def testRunawayLineIsDropped(self):
+		framer = pythonircbot._LineFramer(maxLineLength=100)
+		self.assertEqual(framer.feed(b'x' * 200), [])
+		self.assertEqual(framer.feed(b'\r\nPING :x\r\n'), ['PING :x'])
+
+	def testRunawayLineTailIsDropped(self):
+		framer = pythonircbot._LineFramer(maxLineLength=100)
+		self.assertEqual(framer.feed(b'x' * 200), [])
+		self.assertEqual(framer.feed(b'y' * 50), [])
+		self.assertEqual(framer.feed(b'tail\r\nPING :x\r\n'), ['PING :x'])
+		self.assertEqual(framer.feed(b'PING :y\r\n'), ['PING :y'])
+
+	def testLongLineInOneReadIsDropped(self):
+		framer = pythonircbot._LineFramer(maxLineLength=100)
+		self.assertEqual(framer.feed(b'PING :a\r\n' + b'x' * 200 + b'\r\nPING :b\r\n'), ['PING :a', 'PING :b'])
+
+if __name__ == '__main__':
+	unittest.main()